@@ -0,0 +1,119 @@
+# Copyright (c) 2020, Eli2
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+
+class BlobCache:
+	"""
+	Persistent content addressed store.
+	Keys are hex digests (git blob oids), the least recently used entries are evicted once max_size is exceeded.
+	"""
+
+	path: Path
+	max_size: int
+	hits: int
+	misses: int
+
+	def __init__(self, cache_dir, max_size: int):
+		self.path = Path(cache_dir)
+		self.max_size = max_size
+		self.hits = 0
+		self.misses = 0
+		self._entries = OrderedDict()
+		self._total_size = 0
+		self._lock = threading.Lock()
+
+		os.makedirs(self.path, exist_ok=True)
+		self._scan()
+
+	def _scan(self):
+		found = []
+		for root, dirs, files in os.walk(self.path):
+			root_path = Path(root)
+			for name in files:
+				file_path = root_path / name
+				if name.endswith('.tmp'):
+					os.remove(file_path)
+					continue
+				stat = file_path.stat()
+				found.append((stat.st_mtime, root_path.name + name, stat.st_size))
+
+		# Oldest first, matches the order of self._entries
+		found.sort()
+		for mtime, key, size in found:
+			self._entries[key] = size
+			self._total_size += size
+		self._evict()
+
+	def _blob_path(self, key: str) -> Path:
+		return self.path / key[:2] / key[2:]
+
+	@property
+	def size(self) -> int:
+		return self._total_size
+
+	def __contains__(self, key: str) -> bool:
+		return key in self._entries
+
+	def get(self, key: str) -> Optional[bytes]:
+		with self._lock:
+			if key not in self._entries:
+				self.misses += 1
+				return None
+			self._entries.move_to_end(key)
+
+		blob_path = self._blob_path(key)
+		try:
+			with open(blob_path, 'rb') as file:
+				data = file.read()
+			os.utime(blob_path)
+		except OSError:
+			with self._lock:
+				self._forget(key)
+				self.misses += 1
+			return None
+
+		with self._lock:
+			self.hits += 1
+		return data
+
+	def put(self, key: str, data: bytes):
+		with self._lock:
+			if key in self._entries:
+				self._entries.move_to_end(key)
+				return
+		if len(data) > self.max_size:
+			return
+
+		blob_path = self._blob_path(key)
+		os.makedirs(blob_path.parent, exist_ok=True)
+		fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=blob_path.parent)
+		with os.fdopen(fd, 'wb') as file:
+			file.write(data)
+		os.replace(tmp_path, blob_path)
+
+		with self._lock:
+			if key not in self._entries:
+				self._entries[key] = len(data)
+				self._total_size += len(data)
+			self._evict()
+
+	def _forget(self, key: str):
+		size = self._entries.pop(key, None)
+		if size is not None:
+			self._total_size -= size
+
+	def _evict(self):
+		while self._total_size > self.max_size and self._entries:
+			key, size = self._entries.popitem(last=False)
+			self._total_size -= size
+			try:
+				os.remove(self._blob_path(key))
+			except FileNotFoundError:
+				pass
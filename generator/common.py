@@ -2,6 +2,7 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
 import logging
+import multiprocessing
 
 from dataclasses import dataclass, field
 from pathlib import Path, PurePath
@@ -19,8 +20,43 @@ logging.basicConfig(
 g_log = logging.getLogger()
 g_log.setLevel(logging.INFO)
 
+
+def process_context():
+	"""
+	Start method for worker process pools.
+	Pools are started while threads run, a forked child could inherit a lock held by one of them.
+	"""
+	if 'forkserver' in multiprocessing.get_all_start_methods():
+		return multiprocessing.get_context('forkserver')
+	return multiprocessing.get_context('spawn')
+
+
+class EncoderProfile(NamedTuple):
+	name: str
+	# File extensions, the first one is the fallback for browsers ignoring <picture>
+	formats: Tuple[str] = ('jpg', 'webp')
+	# Fixed quality, or the upper bound when searching for max_bytes / min_psnr
+	quality: Optional[int] = None
+	max_bytes: Optional[int] = None
+	min_psnr: Optional[float] = None
+	progressive: bool = False
+
+
 class ConfigData(NamedTuple):
 	instance_name: str = ''
+	remotes: Tuple[str] = ()
+	responsive_widths: Tuple[int] = ()
+	image_profiles: Tuple[EncoderProfile] = ()
+	# Mods per listing page, 0 puts all mods on one page
+	page_size: int = 0
+	# One page per listing, the browser sorts the tiles
+	client_side_sort: bool = False
+
+	def get_image_profile(self, name: str) -> Optional[EncoderProfile]:
+		for profile in self.image_profiles:
+			if profile.name == name:
+				return profile
+		return None
 
 
 class Picture(NamedTuple):
@@ -75,6 +111,7 @@ class Mod:
 	image_preview: str = ''
 	picture_preview: str = field(default_factory=list)
 	image_gallery: List = field(default_factory=list)
+	image_previews: List = field(default_factory=list)
 	authors: str = ''
 	description: str = ''
 	last_updated: str = ''
@@ -102,6 +139,19 @@ class GroupEntryRef(NamedTuple):
 	spec: GroupSpec
 	entry: GroupEntry
 
+class PageRef(NamedTuple):
+	"""One page of a sorted mod listing"""
+	# Directory and base name of the listing, like tag/foo/index
+	listing: PurePath
+	# Sort key and order suffix, like -name-dsc
+	sort_id: str
+	number: int = 1
+
+	def file_name(self) -> PurePath:
+		suffix = f'-{self.number}' if self.number > 1 else ''
+		return self.listing.with_name(f'{self.listing.name}{self.sort_id}{suffix}.html')
+
+
 class Group(NamedTuple):
 	spec: GroupSpec
 	entries: Tuple[GroupEntry]
@@ -114,6 +164,10 @@ class Group(NamedTuple):
 class PicSrc(NamedTuple):
 	path: PurePath
 	mime: str
+	width: Optional[int] = None
+	height: Optional[int] = None
+	# Smaller copies of the same image as (path, width) pairs
+	srcset: Tuple[Tuple[PurePath, int]] = ()
 
 @dataclass
 class PreviewEntry:
@@ -124,3 +178,5 @@ class PreviewEntry:
 	prev_id: str
 	picture: str
 	thumb_pictures: Tuple[PicSrc]
+	# Tiny blurred version as data URI, shown while the picture loads
+	placeholder: Optional[str] = None
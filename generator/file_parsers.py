@@ -5,7 +5,7 @@ from dataclasses import dataclass, field
 from typing import Any, List, Tuple, NamedTuple
 import re
 
-from generator.common import ConfigData, InfoFile, Creator, Category, Tag
+from generator.common import ConfigData, EncoderProfile, InfoFile, Creator, Category, Tag
 
 def create_id_from_name(name):
 	name = name\
@@ -59,9 +59,16 @@ class ConfigFile(MarkdownFile):
 	_lastHeader: str = ''
 	
 	instance_name: str = ''
+	remotes: List[str] = field(default_factory=list)
+	responsive_widths: List[int] = field(default_factory=list)
+	image_profiles: dict = field(default_factory=dict)
+	page_size: int = 0
+	client_side_sort: bool = False
 
 	def read_h1(self, line):
 		self._lastHeader = line
+		if line.startswith('Image Profile '):
+			self.image_profiles[line[len('Image Profile '):].strip()] = {}
 
 	def read_li(self, line):
 		self.read_text(line)
@@ -70,9 +77,44 @@ class ConfigFile(MarkdownFile):
 		if self._lastHeader == 'Instance Name':
 			self.instance_name = line
 			self._lastHeader = ''
+		elif self._lastHeader == 'Remotes':
+			self.remotes.append(line)
+		elif self._lastHeader == 'Page Size':
+			self.page_size = int(line)
+			self._lastHeader = ''
+		elif self._lastHeader == 'Client Side Sorting':
+			self.client_side_sort = line.lower() in ['yes', 'true', '1']
+			self._lastHeader = ''
+		elif self._lastHeader == 'Responsive Widths':
+			self.responsive_widths.append(int(line))
+		elif self._lastHeader.startswith('Image Profile '):
+			key, value = line.split(':', 1)
+			self.image_profiles[self._lastHeader[len('Image Profile '):].strip()][key.strip().lower()] = value.strip()
+
+	@staticmethod
+	def _encoder_profile(name, values) -> EncoderProfile:
+		profile = EncoderProfile(name)
+		if 'formats' in values:
+			profile = profile._replace(formats=tuple(f.strip().lower() for f in values['formats'].split(',')))
+		if 'quality' in values:
+			profile = profile._replace(quality=int(values['quality']))
+		if 'max bytes' in values:
+			profile = profile._replace(max_bytes=int(values['max bytes']))
+		if 'psnr' in values:
+			profile = profile._replace(min_psnr=float(values['psnr']))
+		if 'progressive' in values:
+			profile = profile._replace(progressive=values['progressive'].lower() in ['yes', 'true', '1'])
+		return profile
 			
 	def get_result(self) -> Any:
-		return ConfigData(self.instance_name)
+		return ConfigData(
+			self.instance_name,
+			tuple(self.remotes),
+			tuple(sorted(self.responsive_widths)),
+			tuple(self._encoder_profile(name, values) for name, values in self.image_profiles.items()),
+			self.page_size,
+			self.client_side_sort
+		)
 
 
 class InfoFileParser(MarkdownFile):
@@ -0,0 +1,98 @@
+# Copyright (c) 2020, Eli2
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import threading
+import time
+from typing import NamedTuple
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .common import g_log
+from .rate_limit import RequestScheduler
+
+
+class HttpSettings(NamedTuple):
+	pool_size: int = 10
+	connect_timeout: float = 10.0
+	read_timeout: float = 60.0
+	keep_alive: bool = True
+	rate: float = 10.0
+	burst: float = 10.0
+	max_retries: int = 5
+
+
+class PooledSession(requests.Session):
+	"""
+	requests.Session with a sized connection pool and a default timeout for every request.
+	Requests are paced by a RequestScheduler and transient failures are retried.
+	"""
+
+	def __init__(self, settings: HttpSettings):
+		super().__init__()
+		self.timeout = (settings.connect_timeout, settings.read_timeout)
+		self.scheduler = RequestScheduler(settings.rate, settings.burst, settings.max_retries)
+
+		adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.pool_size)
+		self.mount('https://', adapter)
+		self.mount('http://', adapter)
+
+		if settings.keep_alive:
+			self.headers['Connection'] = 'keep-alive'
+		else:
+			self.headers['Connection'] = 'close'
+
+	def send(self, request, **kwargs):
+		# Libraries like sgqlc and python-gitlab call send() directly
+		if kwargs.get('timeout') is None:
+			kwargs['timeout'] = self.timeout
+
+		scheduler = self.scheduler
+		resource = scheduler.resource_for(request.url)
+		attempt = 0
+		while True:
+			scheduler.acquire(resource)
+			try:
+				response = super().send(request, **kwargs)
+			except (requests.ConnectionError, requests.Timeout) as ex:
+				if attempt >= scheduler.max_retries:
+					raise
+				delay = scheduler.retry_delay(attempt)
+				g_log.warning(f'{request.method} {request.url} failed ({ex}), retrying in {delay:.1f}s')
+			else:
+				scheduler.update_from_headers(resource, response.headers)
+				if attempt >= scheduler.max_retries or not scheduler.is_transient(response):
+					return response
+				delay = scheduler.retry_delay(attempt, response)
+				g_log.warning(f'{request.method} {request.url} returned {response.status_code}, retrying in {delay:.1f}s')
+				response.close()
+
+			time.sleep(delay)
+			attempt += 1
+
+
+class SessionPool:
+	"""One PooledSession per host, shared by every client talking to that host"""
+
+	settings: HttpSettings
+
+	def __init__(self, settings: HttpSettings = HttpSettings()):
+		self.settings = settings
+		self._sessions = {}
+		self._lock = threading.Lock()
+
+	def get(self, url: str) -> PooledSession:
+		host = urlsplit(url).netloc
+		with self._lock:
+			session = self._sessions.get(host)
+			if not session:
+				session = PooledSession(self.settings)
+				self._sessions[host] = session
+			return session
+
+	def close(self):
+		with self._lock:
+			for session in self._sessions.values():
+				session.close()
+			self._sessions.clear()
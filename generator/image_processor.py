@@ -1,7 +1,422 @@
 # Copyright (c) 2020, Eli2
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+import base64
+import hashlib
+import json
+import math
+import os
+import threading
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from pathlib import PurePath
+from typing import Iterable, List, NamedTuple, Optional, Tuple
+
+import PIL
+from PIL import Image, ImageChops, ImageStat
+
+from .blob_cache import BlobCache
+from .common import g_log, EncoderProfile, process_context
+from .manifest import fingerprint, g_manifest
+from .target import g_target
+
+
+# File extension -> Pillow format, mime type
+OUTPUT_FORMATS = {
+	'jpg': ('JPEG', 'image/jpeg'),
+	'jpeg': ('JPEG', 'image/jpeg'),
+	'webp': ('WEBP', 'image/webp'),
+	'png': ('PNG', 'image/png'),
+}
+
+# Range of the quality search
+MIN_QUALITY = 20
+MAX_QUALITY = 95
+
+
+class ImageVariant(NamedTuple):
+	format: str
+	# Bounding box for thumbnails, None keeps the original size
+	size: Optional[Tuple[int, int]] = None
+	quality: Optional[int] = None
+	progressive: bool = False
+	# Budgets, the quality is searched when one is set
+	max_bytes: Optional[int] = None
+	min_psnr: Optional[float] = None
+
+
+def profile_variant(profile: EncoderProfile, ext: str, size: Tuple[int, int] = None) -> ImageVariant:
+	return ImageVariant(
+		format=OUTPUT_FORMATS[ext][0],
+		size=size,
+		quality=profile.quality,
+		progressive=profile.progressive,
+		max_bytes=profile.max_bytes,
+		min_psnr=profile.min_psnr
+	)
+
+
+class ImageOutput(NamedTuple):
+	path: PurePath
+	variant: ImageVariant
+
+
+class TaskResult(NamedTuple):
+	outputs: List[bytes]
+	# The encoder settings chosen for every output
+	settings: List[dict]
+	duration: float
+
+
+# Part of the cache key, has to change whenever transcode() produces different output
+TRANSCODE_REVISION = 4
+
+# Like Image.thumbnail, cheap downscaling is only used until the image is twice the final size
+REDUCING_GAP = 2
+
+# Modes Image.reduce() does not support
+UNREDUCIBLE_MODES = ('1', 'P', 'I;16', 'I;16L', 'I;16B', 'I;16N')
+
+
+def fit_size(size: Tuple[int, int], box: Tuple[int, int]) -> Tuple[int, int]:
+	"""Largest size with the aspect ratio of size that fits into box, images are never enlarged"""
+	width, height = size
+	scale = min(box[0] / width, box[1] / height, 1.0)
+	return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def _scale(image: Image.Image, size: Tuple[int, int]) -> Image.Image:
+	if image.size == size:
+		return image
+	factor = min(image.width // size[0], image.height // size[1]) // REDUCING_GAP
+	if factor > 1 and image.mode not in UNREDUCIBLE_MODES:
+		image = image.reduce(factor)
+	return image.resize(size, Image.LANCZOS)
+
+
+def _decode(source: bytes, draft_size: Optional[Tuple[int, int]] = None) -> Image.Image:
+	image = Image.open(BytesIO(source))
+	if draft_size:
+		# JPEG is scaled while decoding, other formats ignore this
+		image.draft(image.mode, (draft_size[0] * REDUCING_GAP, draft_size[1] * REDUCING_GAP))
+	image.load()
+	if image.mode == 'P':
+		# Palette images would be scaled with nearest neighbour only
+		image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+	elif image.mode == '1':
+		image = image.convert('L')
+	return image
+
+
+def _encode_variants(image: Image.Image, variants, sizes, outputs: List[bytes], settings: List[dict]):
+	for i, variant in variants:
+		img = _scale(image, sizes[i])
+		if variant.format == 'JPEG' and img.mode not in ['RGB', 'L']:
+			img = img.convert('RGB')
+
+		outputs[i], settings[i] = encode(img, variant)
+
+
+def transcode(source: bytes, variants: Tuple[ImageVariant]) -> TaskResult:
+	"""Encodes every variant of the source, runs in a worker process"""
+	start = time.perf_counter()
+
+	header = Image.open(BytesIO(source))
+	sizes = [fit_size(header.size, v.size) if v.size else header.size for v in variants]
+	full = [(i, v) for i, v in enumerate(variants) if not v.size]
+	reduced = [(i, v) for i, v in enumerate(variants) if v.size]
+
+	outputs = [None] * len(variants)
+	settings = [None] * len(variants)
+	if header.format == 'JPEG' and reduced:
+		# The full size image is released before the reduced variants are decoded again at a fraction of the size
+		if full:
+			_encode_variants(_decode(source), full, sizes, outputs, settings)
+		draft_size = (max(sizes[i][0] for i, _ in reduced), max(sizes[i][1] for i, _ in reduced))
+		_encode_variants(_decode(source, draft_size), reduced, sizes, outputs, settings)
+	else:
+		_encode_variants(_decode(source), full + reduced, sizes, outputs, settings)
+
+	return TaskResult(outputs, settings, time.perf_counter() - start)
+
+
+PLACEHOLDER_SIZE = (16, 16)
+
+
+def make_placeholder(source: bytes) -> str:
+	"""A few hundred bytes JPEG of the image as data URI"""
+	image = Image.open(BytesIO(source))
+	image.draft('RGB', (PLACEHOLDER_SIZE[0] * REDUCING_GAP, PLACEHOLDER_SIZE[1] * REDUCING_GAP))
+	image = image.convert('RGB')
+	image = _scale(image, fit_size(image.size, PLACEHOLDER_SIZE))
+
+	buffer = BytesIO()
+	image.save(buffer, 'JPEG', quality=40, optimize=True)
+	return 'data:image/jpeg;base64,' + base64.b64encode(buffer.getvalue()).decode('ascii')
+
+
+def psnr(reference: Image.Image, data: bytes) -> float:
+	decoded = Image.open(BytesIO(data)).convert('RGB')
+	diff = ImageChops.difference(reference, decoded)
+	mse = sum(v / (diff.width * diff.height) for v in ImageStat.Stat(diff).sum2) / 3
+	if mse == 0:
+		return math.inf
+	return 10 * math.log10(255 ** 2 / mse)
+
+
+def encode(img: Image.Image, variant: ImageVariant) -> Tuple[bytes, dict]:
+	"""Encodes img, searches the quality if the variant has a byte or PSNR budget"""
+	params = {}
+	if variant.format == 'JPEG' and variant.progressive:
+		params['progressive'] = True
+		params['optimize'] = True
+
+	encoded = {}
+
+	def encode_at(quality):
+		if quality not in encoded:
+			buffer = BytesIO()
+			if quality is None:
+				img.save(buffer, variant.format, **params)
+			else:
+				img.save(buffer, variant.format, quality=quality, **params)
+			encoded[quality] = buffer.getvalue()
+		return encoded[quality]
+
+	searched = variant.max_bytes is not None or variant.min_psnr is not None
+	if not searched or variant.format == 'PNG':
+		return encode_at(variant.quality), {'quality': variant.quality}
+
+	low = MIN_QUALITY
+	quality = variant.quality or MAX_QUALITY
+
+	# Both searches assume size and PSNR grow with the quality
+	if variant.min_psnr is not None:
+		reference = img.convert('RGB')
+		quality = _lowest(low, quality, lambda q: psnr(reference, encode_at(q)) >= variant.min_psnr) or quality
+
+	if variant.max_bytes is not None and len(encode_at(quality)) > variant.max_bytes:
+		quality = _highest(low, quality, lambda q: len(encode_at(q)) <= variant.max_bytes) or low
+
+	data = encode_at(quality)
+	return data, {'quality': quality, 'bytes': len(data), 'attempts': len(encoded)}
+
+
+def _lowest(low: int, high: int, ok) -> Optional[int]:
+	"""Binary search for the smallest value in [low, high] that is ok"""
+	if not ok(high):
+		return None
+	while low < high:
+		mid = (low + high) // 2
+		if ok(mid):
+			high = mid
+		else:
+			low = mid + 1
+	return low
+
+
+def _highest(low: int, high: int, ok) -> Optional[int]:
+	"""Binary search for the largest value in [low, high] that is ok"""
+	if not ok(low):
+		return None
+	while low < high:
+		mid = (low + high + 1) // 2
+		if ok(mid):
+			low = mid
+		else:
+			high = mid - 1
+	return low
+
+
 class ImageProcessor:
+	"""
+	Transcodes images on a process pool while pages keep rendering.
+	Identical work (same source bytes and variant) is only done once, even when requested for several outputs.
+	Encoded outputs are kept in a persistent cache, unchanged images are not transcoded again in later builds.
+	"""
+
+	def __init__(self):
+		self._pool = None
+		self._cache = None
+		self._lock = threading.Lock()
+		self._all_done = threading.Condition(self._lock)
+		self._pending = 0
+		self._broken = False
+		# (source hash, variant) -> output paths, the first one is the primary
+		self._variants = {}
+		self._done = set()
+		# (source hash, variant) -> settings chosen by encode()
+		self._settings = {}
+
+		self.task_count = 0
+		self.cached_count = 0
+		self.dedup_count = 0
+		self.failed_count = 0
+		self.bytes_in = 0
+		self.bytes_out = 0
+		self.cpu_time = 0.0
+
+	def start(self, worker_count: int = None, cache: Optional[BlobCache] = None):
+		self._pool = ProcessPoolExecutor(max_workers=worker_count or os.cpu_count(), mp_context=process_context())
+		self._cache = cache
+
+	@staticmethod
+	def cache_key(source_hash: str, variant: ImageVariant) -> str:
+		# Another Pillow version may encode differently
+		return fingerprint(source_hash, variant, PIL.__version__, TRANSCODE_REVISION)
+
+	def add_task(self, source: bytes, outputs: Iterable[ImageOutput]):
+		source_hash = hashlib.sha256(source).hexdigest()
+
+		variants = []
+		cached = []
+		copies = []
+		with self._lock:
+			for output in outputs:
+				key = (source_hash, output.variant)
+				paths = self._variants.get(key)
+				if paths is None:
+					self._variants[key] = [output.path]
+					data, settings = self._cache_get(self.cache_key(source_hash, output.variant))
+					if data is None:
+						variants.append(output.variant)
+					else:
+						cached.append((output.variant, data))
+						self._settings[key] = settings
+				else:
+					self.dedup_count += 1
+					paths.append(output.path)
+					if key in self._done:
+						copies.append((paths[0], output.path))
+			self.cached_count += len(cached)
+
+		for variant, data in cached:
+			self._write_variant((source_hash, variant), data)
+
+		for src, dst in copies:
+			self._copy(src, dst)
+
+		if not variants:
+			return
+
+		variants = tuple(variants)
+		try:
+			future = self._pool.submit(transcode, source, variants)
+		except BrokenProcessPool:
+			# A worker died, e.g. killed for running out of memory
+			with self._lock:
+				self.failed_count += 1
+				self._broken = True
+				self._all_done.notify_all()
+			raise
+		# Only counted once submitted, _on_done is what takes it back
+		with self._lock:
+			self._pending += 1
+		future.add_done_callback(lambda f: self._on_done(f, source_hash, len(source), variants))
+
+	def _on_done(self, future, source_hash, source_size, variants):
+		try:
+			result = future.result()
+			bytes_out = 0
+			for variant, data, settings in zip(variants, result.outputs, result.settings):
+				self._cache_put(self.cache_key(source_hash, variant), data, settings)
+				with self._lock:
+					self._settings[(source_hash, variant)] = settings
+				paths = self._write_variant((source_hash, variant), data)
+				bytes_out += len(data)
+
+			g_log.debug(f'Transcoded {paths[0].parent}: {len(variants)} variants in {result.duration:.2f}s, '
+			            f'{source_size} -> {bytes_out} bytes')
+			with self._lock:
+				self.task_count += 1
+				self.bytes_in += source_size
+				self.bytes_out += bytes_out
+				self.cpu_time += result.duration
+		except Exception as ex:
+			g_log.error(f'Image transcoding failed: {variants}')
+			g_log.exception(ex)
+			with self._lock:
+				self.failed_count += 1
+				if isinstance(ex, BrokenProcessPool):
+					self._broken = True
+		finally:
+			with self._lock:
+				self._pending -= 1
+				self._all_done.notify_all()
+
+	def placeholder(self, source: bytes) -> str:
+		"""make_placeholder() going through the cache, runs in the calling thread as it is cheap"""
+		key = fingerprint(hashlib.sha256(source).hexdigest(), 'placeholder', PIL.__version__, TRANSCODE_REVISION)
+		data = self._cache.get(key) if self._cache else None
+		if data is not None:
+			return data.decode('ascii')
+		placeholder = make_placeholder(source)
+		if self._cache:
+			self._cache.put(key, placeholder.encode('ascii'))
+		return placeholder
+
+	def _cache_get(self, key: str) -> Tuple[Optional[bytes], Optional[dict]]:
+		if not self._cache:
+			return None, None
+		# Both have to be present, either one can get evicted
+		settings = self._cache.get(fingerprint(key, 'settings'))
+		data = self._cache.get(key) if settings is not None else None
+		if data is None:
+			return None, None
+		return data, json.loads(settings)
+
+	def _cache_put(self, key: str, data: bytes, settings: dict):
+		if self._cache:
+			self._cache.put(key, data)
+			self._cache.put(fingerprint(key, 'settings'), json.dumps(settings).encode('utf-8'))
+
+	def _write_variant(self, key, data: bytes) -> List[PurePath]:
+		with self._lock:
+			paths = list(self._variants[key])
+		for path in paths:
+			with g_target.checked_open(path, 'wb') as f:
+				f.write(data)
+		with self._lock:
+			# Outputs requested while writing still need a copy
+			late_paths = self._variants[key][len(paths):]
+			self._done.add(key)
+		for path in late_paths:
+			with g_target.checked_open(path, 'wb') as f:
+				f.write(data)
+		return paths
+
+	def _copy(self, src: PurePath, dst: PurePath):
+		with g_target.checked_open(src, 'rb') as f:
+			data = f.read()
+		with g_target.checked_open(dst, 'wb') as f:
+			f.write(data)
+
+	def finish(self):
+		with self._lock:
+			while self._pending and not self._broken:
+				self._all_done.wait()
+		if self._pool:
+			self._pool.shutdown()
+			self._pool = None
+		if self._broken:
+			raise BrokenProcessPool('An image worker process died, outputs are missing')
+
+		self._record_settings()
+
+		g_log.info(f'Images: {self.task_count} transcoded, {self.cached_count} outputs from cache, '
+		           f'{self.dedup_count} deduplicated, {self.failed_count} failed, '
+		           f'{self.bytes_in} -> {self.bytes_out} bytes in {self.cpu_time:.1f}s')
 
-	def addTask(self, inputPath, outputPath):
-		pass
+	def _record_settings(self):
+		"""Keeps the encoder settings of every output in the build manifest"""
+		previous = g_manifest.get_state('images') or {}
+		# Images of unchanged pages are not processed again, their settings are carried forward
+		settings = {path: s for path, s in previous.items() if g_target.exists(PurePath(path))}
+		for key, paths in self._variants.items():
+			if key in self._settings:
+				for path in paths:
+					settings[str(path)] = self._settings[key]
+		g_manifest.set_state('images', settings)
@@ -0,0 +1,106 @@
+# Copyright (c) 2020, Eli2
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import hashlib
+import json
+import os
+from pathlib import Path, PurePath
+from typing import Any, Iterable, Optional
+
+from .common import g_log
+from .target import g_target
+
+
+def fingerprint(*parts) -> str:
+	data = json.dumps(parts, sort_keys=True, default=str, ensure_ascii=False)
+	return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def fingerprint_files(paths: Iterable[Path]) -> str:
+	digest = hashlib.sha256()
+	for path in paths:
+		for root, dirs, files in os.walk(path):
+			dirs.sort()
+			dirs[:] = [d for d in dirs if d != '__pycache__']
+			for name in sorted(files):
+				file_path = Path(root) / name
+				digest.update(str(file_path).encode('utf-8'))
+				with open(file_path, 'rb') as file:
+					digest.update(hashlib.sha256(file.read()).digest())
+	return digest.hexdigest()
+
+
+class BuildManifest:
+	"""
+	Remembers the fingerprint of the inputs of every output.
+	Outputs whose inputs did not change since the last build are skipped.
+	"""
+
+	path: Path
+	enabled: bool
+	fresh_count: int
+	built_count: int
+
+	def __init__(self):
+		self.path = None
+		self.enabled = False
+		self.fresh_count = 0
+		self.built_count = 0
+		self._previous = {}
+		self._current = {}
+
+	def load(self, path: Path, enabled: bool = True):
+		self.path = path
+		self.enabled = enabled
+		if not enabled or not path.exists():
+			return
+		try:
+			with open(path, encoding='utf-8') as file:
+				data = json.load(file)
+			self._previous = data['outputs']
+		except (ValueError, KeyError) as ex:
+			g_log.warning(f'Ignoring broken build manifest {path}: {ex}')
+
+	def save(self):
+		if not self.path:
+			return
+		tmp_path = self.path.with_name(self.path.name + '.tmp')
+		with open(tmp_path, 'w', encoding='utf-8') as file:
+			json.dump({'version': 1, 'outputs': self._current}, file, ensure_ascii=False)
+		os.replace(tmp_path, self.path)
+
+	def is_fresh(self, key: str, input_fingerprint: str) -> bool:
+		previous = self._previous.get(key)
+		fresh = self.enabled \
+			and previous is not None \
+			and previous['fingerprint'] == input_fingerprint \
+			and all(g_target.exists(PurePath(p)) for p in previous['outputs'])
+		if fresh:
+			self._current[key] = previous
+			self.fresh_count += 1
+		return fresh
+
+	def record(self, key: str, input_fingerprint: str, outputs: Iterable[PurePath], state: Any = None):
+		self._current[key] = {
+			'fingerprint': input_fingerprint,
+			'outputs': [str(p) for p in outputs],
+			'state': state
+		}
+		self.built_count += 1
+
+	def set_state(self, key: str, state: Any):
+		"""Stores data that is not tied to an output"""
+		self._current[key] = {
+			'fingerprint': None,
+			'outputs': [],
+			'state': state
+		}
+
+	def get_state(self, key: str) -> Optional[Any]:
+		entry = self._current.get(key) or self._previous.get(key)
+		if entry:
+			return entry['state']
+		return None
+
+
+g_manifest = BuildManifest()
@@ -0,0 +1,144 @@
+# Copyright (c) 2020, Eli2
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import random
+import threading
+import time
+
+from datetime import datetime, timezone
+from typing import Optional
+
+from .common import g_log
+
+
+class TokenBucket:
+	"""Allows `rate` tokens per second on average and bursts of up to `capacity` tokens"""
+
+	def __init__(self, rate: float, capacity: float):
+		self.rate = rate
+		self.capacity = capacity
+		self._tokens = capacity
+		self._last = time.monotonic()
+
+	def _refill(self, now: float):
+		self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+		self._last = now
+
+	def take(self, tokens: float, now: float) -> float:
+		"""Takes the tokens, returns how long the caller has to wait before using them"""
+		self._refill(now)
+		self._tokens -= tokens
+		if self._tokens >= 0:
+			return 0.0
+		return -self._tokens / self.rate
+
+
+class RequestScheduler:
+	"""
+	Paces the requests to one host.
+	Every resource (GitHub has separate REST and GraphQL budgets) gets a token bucket. Once the rate limit
+	headers report less than RESERVE of the budget left, the rate is lowered so the rest lasts until the reset.
+	"""
+
+	TRANSIENT_STATUS = (429, 500, 502, 503, 504)
+	RESERVE = 0.1
+
+	def __init__(self, rate: float = 10.0, burst: float = 10.0, max_retries: int = 5,
+	             base_delay: float = 1.0, max_delay: float = 60.0):
+		self.rate = rate
+		self.burst = burst
+		self.max_retries = max_retries
+		self.base_delay = base_delay
+		self.max_delay = max_delay
+
+		self._buckets = {}
+		self._blocked_until = {}
+		self._lock = threading.Lock()
+
+	@staticmethod
+	def resource_for(url: str) -> str:
+		if url.split('?', 1)[0].endswith('/graphql'):
+			return 'graphql'
+		return 'core'
+
+	def _bucket(self, resource: str) -> TokenBucket:
+		bucket = self._buckets.get(resource)
+		if not bucket:
+			bucket = TokenBucket(self.rate, self.burst)
+			self._buckets[resource] = bucket
+		return bucket
+
+	def acquire(self, resource: str, cost: float = 1.0):
+		with self._lock:
+			now = time.monotonic()
+			delay = max(0.0, self._blocked_until.get(resource, 0.0) - now)
+			delay += self._bucket(resource).take(cost, now + delay)
+		if delay > 0:
+			time.sleep(delay)
+
+	def charge(self, resource: str, cost: float):
+		"""Accounts for extra cost only known after the response arrived"""
+		with self._lock:
+			self._bucket(resource).take(cost, time.monotonic())
+
+	def _update_budget(self, resource: str, limit: Optional[int], remaining: int, reset_at: float):
+		with self._lock:
+			seconds_left = max(1.0, reset_at - time.time())
+			if remaining <= 0:
+				self._blocked_until[resource] = time.monotonic() + seconds_left
+				g_log.warning(f'Rate limit of {resource} exhausted, pausing for {seconds_left:.0f}s')
+				return
+			bucket = self._bucket(resource)
+			if limit and remaining > limit * self.RESERVE:
+				bucket.rate = self.rate
+			else:
+				# Running low, spread what is left evenly until the budget resets
+				bucket.rate = min(self.rate, remaining / seconds_left)
+
+	def update_from_headers(self, resource: str, headers):
+		# GitHub uses X-RateLimit-*, GitLab RateLimit-*, both report the reset as unix time
+		limit = headers.get('X-RateLimit-Limit') or headers.get('RateLimit-Limit')
+		remaining = headers.get('X-RateLimit-Remaining') or headers.get('RateLimit-Remaining')
+		reset = headers.get('X-RateLimit-Reset') or headers.get('RateLimit-Reset')
+		if remaining is None or reset is None:
+			return
+		try:
+			limit = int(limit) if limit else None
+			self._update_budget(headers.get('X-RateLimit-Resource', resource), limit, int(remaining), float(reset))
+		except ValueError:
+			pass
+
+	def update_graphql(self, rate_limit: Optional[dict]):
+		"""Consumes the `rateLimit { limit cost remaining resetAt }` object of a GraphQL response"""
+		if not rate_limit:
+			return
+		cost = rate_limit.get('cost') or 1
+		if cost > 1:
+			self.charge('graphql', cost - 1)
+		reset_at = datetime.strptime(rate_limit['resetAt'], '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc)
+		self._update_budget('graphql', rate_limit.get('limit'), rate_limit['remaining'], reset_at.timestamp())
+
+	def is_transient(self, response) -> bool:
+		if response.status_code in self.TRANSIENT_STATUS:
+			return True
+		if response.status_code == 403:
+			# GitHub reports secondary and exhausted primary limits as 403
+			if response.headers.get('Retry-After') or response.headers.get('X-RateLimit-Remaining') == '0':
+				return True
+			return 'rate limit' in response.text.lower()
+		return False
+
+	def retry_delay(self, attempt: int, response=None) -> float:
+		if response is not None:
+			retry_after = response.headers.get('Retry-After')
+			if retry_after:
+				try:
+					return float(retry_after)
+				except ValueError:
+					pass
+			if response.headers.get('X-RateLimit-Remaining') == '0':
+				reset = response.headers.get('X-RateLimit-Reset')
+				if reset:
+					return max(1.0, float(reset) - time.time())
+		# Full jitter, spreads the retries of concurrent workers
+		return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
@@ -4,13 +4,14 @@
 import os
 
 from datetime import datetime
-from pathlib import PurePath
+from pathlib import Path, PurePath
 
 from markupsafe import Markup
 from jinja2 import Environment, FileSystemLoader, select_autoescape
 from jinja2 import contextfilter
 
-from .common import Mod, Category, Tag, Creator, GroupSpec, GroupEntryRef
+from .common import Mod, Category, Tag, Creator, GroupSpec, GroupEntryRef, PageRef
+from .manifest import fingerprint_files
 from generator.target import g_target
 
 
@@ -23,6 +24,16 @@ jinja_env = Environment(
 
 jinja_env.globals['g_page_generation_time'] = datetime.now()
 
+_template_fingerprint = None
+
+
+def template_fingerprint() -> str:
+	# The generator code renders pages as well, changes to it invalidate them too
+	global _template_fingerprint
+	if not _template_fingerprint:
+		_template_fingerprint = fingerprint_files([Path('./page'), Path(__file__).parent])
+	return _template_fingerprint
+
 
 def human_bytes(size):
 	for x in ['bytes', 'KB', 'MB', 'GB']:
@@ -38,43 +49,58 @@ def html_indent(s, depth):
 	return rv
 
 
-@contextfilter
-def makepath(ctx, pointer):
-	current_path = ctx.environment.globals['g_BAR']
-
-	if isinstance(pointer, Mod):
-		target = PurePath(pointer.repo.game_id, pointer.repo.mod_id, 'index.html')
+def target_path(pointer) -> str:
+	"""Canonical output path of what a link points to"""
+	if isinstance(pointer, str):
+		return pointer
+	elif isinstance(pointer, PurePath):
+		return pointer.as_posix()
+	elif isinstance(pointer, Mod):
+		return f'{pointer.repo.game_id}/{pointer.repo.mod_id}/index.html'
 	elif isinstance(pointer, Category):
-		target = PurePath('category', pointer.id, 'index.html')
+		return f'category/{pointer.id}/index.html'
 	elif isinstance(pointer, Tag):
-		target = PurePath('tag', pointer.id, 'index.html')
+		return f'tag/{pointer.id}/index.html'
 	elif isinstance(pointer, Creator):
-		target = PurePath('creator', pointer.id, 'index.html')
+		return f'creator/{pointer.id}/index.html'
 	elif isinstance(pointer, GroupSpec):
-		target = PurePath(pointer.id, 'index.html')
+		return f'{pointer.id}/index.html'
 	elif isinstance(pointer, GroupEntryRef):
-		target = PurePath(pointer.spec.id, pointer.entry.id, 'index.html')
-	elif isinstance(pointer, str):
-		target = PurePath(pointer)
-	elif isinstance(pointer, PurePath):
-		target = pointer
+		return f'{pointer.spec.id}/{pointer.entry.id}/index.html'
+	elif isinstance(pointer, PageRef):
+		return pointer.file_name().as_posix()
 	else:
 		raise Exception(f'Unexpected type for makepath {type(pointer)}')
 
-	current_depth = len(current_path.parent.parts)
-	
-	# os.path.commonprefix(list)
-	
-	i = 0
-	for a, b in zip(current_path.parent.parts, target.parent.parts):
-		if a != b:
-			break;
-		i += 1
-	
-	walk_up = ['.'] + ['..'] * (current_depth - i)
-	rel_path = PurePath(*walk_up) / PurePath(*target.parts[i:])
-	# g_log.info(f'src: {current_path} dst {target} -> rel {rel_path}')
-	return rel_path
+
+# Output directory -> {target path -> relative url}, every page in a directory links the same way
+_relative_urls = {}
+
+
+def relative_url(current_dir: PurePath, target: str) -> str:
+	urls = _relative_urls.get(current_dir)
+	if urls is None:
+		urls = _relative_urls.setdefault(current_dir, {})
+
+	url = urls.get(target)
+	if url is None:
+		target_path = PurePath(target)
+		
+		i = 0
+		for a, b in zip(current_dir.parts, target_path.parent.parts):
+			if a != b:
+				break;
+			i += 1
+		
+		walk_up = ['.'] + ['..'] * (len(current_dir.parts) - i)
+		url = str(PurePath(*walk_up) / PurePath(*target_path.parts[i:]))
+		urls[target] = url
+	return url
+
+
+@contextfilter
+def makepath(ctx, pointer):
+	return relative_url(ctx['g_page_path'].parent, target_path(pointer))
 
 
 jinja_env.filters['human_bytes'] = human_bytes
@@ -82,15 +108,20 @@ jinja_env.filters['ind'] = html_indent
 jinja_env.filters['makepath'] = makepath
 
 
+def render_fragment(fragment_name: PurePath, render_dict: dict, page_path: PurePath) -> Markup:
+	"""Renders markup to be spliced into the page at page_path"""
+	template = jinja_env.get_template(str(fragment_name))
+	return Markup(template.render(render_dict, g_page_path=page_path))
+
+
 def render_main_page(page_name: PurePath, render_dict: dict, out_page_name: PurePath = None):
 	
 	if not out_page_name:
 		out_page_name = page_name
 	
-	jinja_env.globals['g_BAR'] = out_page_name
-	
+	# Links are relative to the page, every render gets its own path instead of a shared global
 	template = jinja_env.get_template(str(page_name))
-	rendered = template.render(render_dict)
+	rendered = template.render(render_dict, g_page_path=out_page_name)
 	
 	with g_target.checked_open(out_page_name, 'w') as f:
 		f.write(rendered)
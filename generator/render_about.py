@@ -4,7 +4,8 @@
 from pathlib import Path, PurePath
 from markdown import markdown
 
-from .render import render_main_page
+from .manifest import fingerprint, g_manifest
+from .render import render_main_page, template_fingerprint
 
 
 def render_about_page(config, all_mods, all_grps):
@@ -20,10 +21,17 @@ def render_about_page(config, all_mods, all_grps):
 	with open('./LICENSE/agpl-3.0.md', encoding='utf-8') as file:
 		license_md = file.read()
 	
+	out_path = PurePath('about.html')
+	input_fingerprint = fingerprint(template_fingerprint(), config, [(g.spec.id, g.spec.name) for g in all_grps],
+	                                about_md, license_md)
+	if g_manifest.is_fresh('about', input_fingerprint):
+		return
+	
 	about_html = markdown(about_md, extensions=['nl2br', 'fenced_code'])
 	license_html = markdown(license_md, extensions=['nl2br', 'fenced_code'])
 	
 	cpy = render_args.copy()
 	cpy['about_html'] = about_html
 	cpy['license_html'] = license_html
-	render_main_page(PurePath('about.html'), cpy)
+	render_main_page(out_path, cpy)
+	g_manifest.record('about', input_fingerprint, [out_path])
@@ -1,11 +1,115 @@
 # Copyright (c) 2020, Eli2
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+import math
+
+from datetime import datetime
 from pathlib import PurePath
-from typing import Any, Callable, NamedTuple
+from typing import Any, Callable, List, NamedTuple, Optional, Sequence, Tuple
+
+from jinja2 import contextfunction
+from markupsafe import Markup
+
+from .common import Mod, PageRef
+from .manifest import fingerprint, g_manifest
+from .render import render_fragment, render_main_page, template_fingerprint
+
+
+def tile_inputs(mod: Mod):
+	"""Everything the index pages show of a mod"""
+	return (
+		mod.repo.game_id,
+		mod.repo.mod_id,
+		mod.info,
+		mod.star_count,
+		len(mod.data_files),
+		mod.data_files_size,
+		mod.picture_preview,
+		mod.image_previews[0].placeholder if mod.image_previews else None
+	)
+
+
+DATE_FORMATS = ('%Y-%m-%d %H:%M', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d')
+
+
+def date_timestamp(text: str) -> float:
+	"""Sortable value of a date from a mod-info.md, unparsable dates sort before all others"""
+	text = text.strip() if text else ''
+	for date_format in DATE_FORMATS:
+		try:
+			return datetime.strptime(text, date_format).timestamp()
+		except ValueError:
+			pass
+	return float('-inf')
+
+
+class SortIndex:
+	"""
+	Global ascending order of all mods for every sort key, computed once.
+	Listings derive their order from the global ranks instead of sorting with the key functions,
+	descending orders are the reversed ascending ones.
+	"""
+
+	def __init__(self, mods: Sequence[Mod], sort_bys):
+		self._mods = list(mods)
+		self._positions = {(m.repo.game_id, m.repo.mod_id): i for i, m in enumerate(self._mods)}
+		self._orders = {}
+		self._ranks = {}
+		for sort_by in sort_bys:
+			keys = [sort_by.key_getter(m) for m in self._mods]
+			# The position breaks ties, so every listing orders equal mods the same way
+			order = sorted(range(len(keys)), key=lambda i: (keys[i], i))
+			ranks = [0] * len(order)
+			for rank, i in enumerate(order):
+				ranks[i] = rank
+			self._orders[sort_by.id] = order
+			self._ranks[sort_by.id] = ranks
+
+	def ranks(self, mod: Mod) -> List[Tuple[str, int]]:
+		"""(sort id, ascending rank) of the mod for every sort key"""
+		position = self._positions[(mod.repo.game_id, mod.repo.mod_id)]
+		return [(sort_id, ranks[position]) for sort_id, ranks in self._ranks.items()]
+
+	def ascending(self, mods: Sequence[Mod], sort_id: str) -> List[Mod]:
+		positions = [self._positions[(m.repo.game_id, m.repo.mod_id)] for m in mods]
+		if len(positions) * max(1, len(positions).bit_length()) < len(self._mods):
+			# Small listing, sorting its integer ranks is cheaper than walking the global order
+			ranks = self._ranks[sort_id]
+			positions.sort(key=ranks.__getitem__)
+			return [self._mods[i] for i in positions]
+
+		members = set(positions)
+		return [self._mods[i] for i in self._orders[sort_id] if i in members]
+
+
+class TileCache:
+	"""
+	Renders the tile of every mod once per output directory depth, index pages splice in the markup.
+	The tiles are rendered for a directory sharing no prefix with any target, so their relative links
+	work from every directory of the same depth.
+	"""
+
+	def __init__(self, config, sort_index: Optional[SortIndex] = None):
+		self._config = config
+		self._sort_index = sort_index
+		self._tiles = {}
+
+	def get(self, mod: Mod, page_path: PurePath, loading: str) -> Markup:
+		depth = len(page_path.parent.parts)
+		key = (mod.repo.game_id, mod.repo.mod_id, depth, loading)
+		tile = self._tiles.get(key)
+		if tile is None:
+			neutral_path = PurePath(*['_'] * depth, 'index.html')
+			render_args = {
+				'config': self._config,
+				'mod': mod,
+				'loading': loading,
+				'sort_ranks': self._sort_index.ranks(mod) if self._sort_index else ()
+			}
+			tile = render_fragment(PurePath('fragment/mod-tile.html'), render_args, neutral_path)
+			self._tiles[key] = tile
+		return tile
 
-from .common import Mod
-from .render import render_main_page
 
 def render_index_pages(config, all_mods, all_grps):
 	
@@ -14,6 +118,10 @@ def render_index_pages(config, all_mods, all_grps):
 		'mods': all_mods,
 		'groups': all_grps
 	}
+
+
+	header_inputs = [(g.spec.id, g.spec.name) for g in all_grps]
+	page_inputs = (template_fingerprint(), config, header_inputs)
 	
 	class SortBy(NamedTuple):
 		id: str
@@ -26,9 +134,9 @@ def render_index_pages(config, all_mods, all_grps):
 		reverse: bool
 	
 	sort_bys = (
-		SortBy('', 'Update Date', True, lambda mod: mod.info.update_date),
+		SortBy('', 'Update Date', True, lambda mod: date_timestamp(mod.info.update_date)),
 		SortBy('-name', 'Name', False, lambda mod: mod.info.name),
-		SortBy('-release-date', 'Release Date', True, lambda mod: mod.info.release_date),
+		SortBy('-release-date', 'Release Date', True, lambda mod: date_timestamp(mod.info.release_date)),
 		SortBy('-file-count', 'File Count', False, lambda mod: len(mod.data_files)),
 		SortBy('-file-size', 'File Size', False, lambda mod: mod.data_files_size),
 	)
@@ -37,48 +145,101 @@ def render_index_pages(config, all_mods, all_grps):
 		SortOrder('', False),
 		SortOrder('-dsc', True)
 	)
+
+	all_sort_bys = sort_bys
+	sort_index = SortIndex(all_mods, sort_bys)
+
+	# The tiles carry their sort ranks, sort.js reorders them
+	tile_cache = TileCache(config, sort_index if config.client_side_sort else None)
+	if config.client_side_sort:
+		sort_bys = sort_bys[:1]
+		sort_orders = sort_orders[:1]
+
+	@contextfunction
+	def mod_tile(ctx, mod, loading):
+		return tile_cache.get(mod, ctx['g_page_path'], loading)
+
+	render_args['mod_tile'] = mod_tile
 	
-	def render_mod_index(base_path, base_name, mods):
+	def render_mod_index(base_path, base_name, title, mods):
+		
+		listing = base_path / base_name
+		page_size = config.page_size or max(1, len(mods))
+		if config.client_side_sort:
+			# Sorting in the browser only works on the full list
+			page_size = max(1, len(mods))
+		page_count = max(1, math.ceil(len(mods) / page_size))
+
+		file_names = []
+		for sort_by in sort_bys:
+			for sort_order in sort_orders:
+				for number in range(1, page_count + 1):
+					file_names.append(PageRef(listing, sort_by.id + sort_order.id, number).file_name())
+
+		# Only depends on what the tiles show, a change elsewhere in a mod keeps the listing
+		manifest_key = f'index:{listing}'
+		input_fingerprint = fingerprint(page_inputs, str(base_path), title, [tile_inputs(m) for m in mods])
+		if g_manifest.is_fresh(manifest_key, input_fingerprint):
+			return
 		
 		class SortLink(NamedTuple):
 			id: str
 			name: str
-			asc_url: str
-			dsc_url: str
+			reverse: bool
+			asc_url: PageRef
+			dsc_url: PageRef
 		
 		sort_links = []
-		for sort_by in sort_bys:
+		for sort_by in all_sort_bys:
+			if config.client_side_sort:
+				# Without JS every order shows the only page there is
+				asc_url = dsc_url = PageRef(listing, '')
+			else:
+				asc_url = PageRef(listing, sort_by.id)
+				dsc_url = PageRef(listing, sort_by.id + '-dsc')
 			sort_links.append(SortLink(
 				id=sort_by.id,
 				name=sort_by.name,
-				asc_url=base_path / (base_name + sort_by.id + '.html'),
-				dsc_url=base_path / (base_name + sort_by.id + '-dsc.html')
+				reverse=sort_by.reverse,
+				asc_url=asc_url,
+				dsc_url=dsc_url
 			))
 		render_args['sort_links'] = sort_links
 		
 		for sort_by in sort_bys:
 			render_args['sort_by'] = sort_by
+			ascending = sort_index.ascending(mods, sort_by.id)
 			for sort_order in sort_orders:
 				render_args['sort_order'] = sort_order
 				
-				file_name = base_path / (base_name + sort_by.id + sort_order.id + '.html')
-				
 				reverse = sort_by.reverse
 				if sort_order.reverse:
 					reverse = not reverse
-				
-				sorted_mods = list(mods)
-				sorted_mods.sort(key=sort_by.key_getter, reverse=reverse)
-				
-				render_args['mods'] = sorted_mods
+				sorted_mods = ascending[::-1] if reverse else ascending
+
+				pages = [PageRef(listing, sort_by.id + sort_order.id, n) for n in range(1, page_count + 1)]
+				render_args['pages'] = pages
 				render_args['base_name'] = base_name
-				render_main_page(PurePath('index.html'), render_args, file_name)
+				for page in pages:
+					start = (page.number - 1) * page_size
+					render_args['page'] = page
+					render_args['mods'] = sorted_mods[start:start + page_size]
+					render_main_page(PurePath('index.html'), render_args, page.file_name())
+
+		g_manifest.record(manifest_key, input_fingerprint, file_names)
 	
-	render_mod_index(PurePath(), 'index', all_mods)
+	render_mod_index(PurePath(), 'index', None, all_mods)
 	
 	for group in all_grps:
 		render_args['group'] = group
-		render_main_page(PurePath('group.html'), render_args, PurePath(group.spec.id, 'index.html'))
+
+		group_file_name = PurePath(group.spec.id, 'index.html')
+		manifest_key = f'group:{group.spec.id}'
+		input_fingerprint = fingerprint(page_inputs, group.spec.id, [(e.id, e.name, len(e.mods)) for e in group.entries])
+		if not g_manifest.is_fresh(manifest_key, input_fingerprint):
+			render_main_page(PurePath('group.html'), render_args, group_file_name)
+			g_manifest.record(manifest_key, input_fingerprint, [group_file_name])
+
 		for entry in group.entries:
 			render_args['group_entry'] = entry
-			render_mod_index(PurePath(group.spec.id, entry.id), 'index', entry.mods)
+			render_mod_index(PurePath(group.spec.id, entry.id), 'index', (group.spec.id, entry.name), entry.mods)
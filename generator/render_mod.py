@@ -1,17 +1,22 @@
 # Copyright (c) 2020, Eli2
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+import dataclasses
+
 from io import BytesIO
 
 from pathlib import PurePath
 from PIL import Image
-from typing import Optional, Tuple, List, NamedTuple
+from typing import Callable, Optional, Tuple, List, NamedTuple
 
 import markdown
 from generator.markdown_flavour import NextmodMarkdown
 
 from .common import g_log, PicSrc, Picture, Mod, PreviewEntry
-from .render import render_main_page
+from .image_processor import ImageOutput, ImageProcessor, ImageVariant, OUTPUT_FORMATS, fit_size, make_placeholder, profile_variant
+from .source import RepositoryRef
+from .manifest import fingerprint, g_manifest
+from .render import render_main_page, template_fingerprint
 from .target import g_target
 
 
@@ -67,11 +72,72 @@ def parse_image_filename(filename: str) -> Optional[Picture]:
 		g_log.warn("Unknown image type prefix found %", image_type)
 
 
-def render_mod_page(config, app_args, all_mods: Tuple[Mod], all_grps, mod: Mod):
-	
-	mod_directory = PurePath(mod.repo.game_id) / mod.repo.mod_id
-	image_directory = mod_directory / 'image'
-	
+def mod_input_fingerprint(config, mod: Mod) -> str:
+	repo = mod.repo
+	files = [('mod-info.md', repo.get_file_oid(PurePath('mod-info.md')))]
+	for dir_name in ['image', 'page']:
+		for name in sorted(repo.list_dir(PurePath(dir_name))):
+			files.append((f'{dir_name}/{name}', repo.get_file_oid(PurePath(dir_name, name))))
+	# Only what the mod page reads, listing settings must not invalidate every page
+	page_config = (config.instance_name, config.responsive_widths, config.image_profiles)
+	return fingerprint(template_fingerprint(), page_config, repo.game_id, repo.mod_id, files)
+
+
+def _pictures_to_json(pictures):
+	if not pictures:
+		return pictures
+	return [dict(p._asdict(), path=str(p.path), srcset=[(str(path), width) for path, width in p.srcset]) for p in pictures]
+
+
+def _pictures_from_json(data):
+	if not data:
+		return data
+	return [PicSrc(**dict(
+		p,
+		path=PurePath(p['path']),
+		srcset=tuple((PurePath(path), width) for path, width in p.get('srcset', ()))
+	)) for p in data]
+
+
+def mod_page_state(mod: Mod) -> dict:
+	"""The results of render_mod_page that other pages depend on"""
+	previews = []
+	for preview in mod.image_previews:
+		entry = dataclasses.asdict(preview)
+		entry['picture'] = _pictures_to_json(preview.picture)
+		entry['thumb_pictures'] = _pictures_to_json(preview.thumb_pictures)
+		previews.append(entry)
+	return {
+		'banner_picture': _pictures_to_json(mod.banner_picture),
+		'image_previews': previews
+	}
+
+
+def restore_mod_page_state(mod: Mod, state: dict):
+	mod.banner_picture = _pictures_from_json(state['banner_picture'])
+	previews = []
+	for entry in state['image_previews']:
+		entry = dict(entry)
+		entry['picture'] = _pictures_from_json(entry['picture'])
+		entry['thumb_pictures'] = tuple(_pictures_from_json(entry['thumb_pictures']))
+		previews.append(PreviewEntry(**entry))
+	mod.image_previews = previews
+	if mod.image_previews:
+		mod.picture_preview = mod.image_previews[0].thumb_pictures
+
+
+class ImageTask(NamedTuple):
+	source: bytes
+	outputs: Tuple[ImageOutput]
+
+
+def plan_mod_images(config, image_directory: PurePath, image_files,
+                    placeholder: Callable[[bytes], str] = make_placeholder) -> Tuple[Optional[List[PicSrc]], List[PreviewEntry], List[ImageTask]]:
+	"""
+	Decides which files are generated for the images of a mod.
+	Only the image headers and placeholders are decoded, the actual transcoding is left to the ImageProcessor.
+	"""
+
 	# images
 	def out_rel_url(name: str):
 		return image_directory / name
@@ -80,25 +146,29 @@ def render_mod_page(config, app_args, all_mods: Tuple[Mod], all_grps, mod: Mod):
 		image_info: Picture
 		picture: List[PicSrc]
 		thumb_pictures: List[PicSrc]
+		placeholder: str
 	
 	
 	foo = []
+	tasks = []
+
+	full_profile = config.get_image_profile('full')
+	thumb_profile = config.get_image_profile('thumb')
+	responsive_widths = config.responsive_widths
 	
 	banner_picture = None
 	
-	page_images_gen = mod.repo.list_dir(dir_path=PurePath('image'))
-	for input_file_name in page_images_gen:
+	for input_file_name, image_data in image_files:
 
 		image_info = parse_image_filename(input_file_name)
 		if not image_info:
 			continue
 
 		try:
-			image_data = mod.repo.get_file(file_path='image/' + input_file_name)
 			image = Image.open(BytesIO(image_data))
 			# image.verify()
 		except Exception as ex:
-			g_log.log("Failed to load image: {}".format(input_file_name))
+			g_log.error("Failed to load image: {}".format(input_file_name))
 			g_log.exception(ex)
 			continue
 		
@@ -111,67 +181,68 @@ def render_mod_page(config, app_args, all_mods: Tuple[Mod], all_grps, mod: Mod):
 			            image.format)
 			continue
 		
+		outputs = []
 		picture = []
-		if image.format in ['PNG']:
-			img = image.convert('RGB')
-			name = image_info.out_name('jpg') 
-			with g_target.checked_open(image_directory / name, 'wb') as f:
-				img.save(f, 'JPEG')
-				picture.append(PicSrc(out_rel_url(name), 'image/jpeg'))
-			
-			name = image_info.out_name('webp')
-			with g_target.checked_open(image_directory / name, 'wb') as f:
-				image.save(f, 'WebP', quality=100)
-				picture.append(PicSrc(out_rel_url(name), 'image/webp'))
-		
+		width, height = image.size
+		srcset_widths = [w for w in responsive_widths if w < width]
+
+		def add_source(ext: str, mime: str, variant: ImageVariant):
+			# Responsive copies are encoded in the same task, the source is fetched and sent only once
+			srcset = []
+			for srcset_width in srcset_widths:
+				name = image_info.out_name(ext, f'{srcset_width}w')
+				size = fit_size(image.size, (srcset_width, height))
+				scaled = variant._replace(size=size)
+				if variant.max_bytes:
+					# The budget is meant for the full size, smaller copies get their share by area
+					scaled = scaled._replace(max_bytes=variant.max_bytes * size[0] * size[1] // (width * height))
+				outputs.append(ImageOutput(image_directory / name, scaled))
+				srcset.append((out_rel_url(name), size[0]))
+
+			name = image_info.out_name(ext)
+			outputs.append(ImageOutput(image_directory / name, variant))
+			picture.append(PicSrc(out_rel_url(name), mime, width, height, tuple(srcset)))
+
+		if full_profile:
+			for ext in full_profile.formats:
+				add_source(ext, OUTPUT_FORMATS[ext][1], profile_variant(full_profile, ext))
+		elif image.format in ['PNG']:
+			add_source('jpg', 'image/jpeg', ImageVariant('JPEG'))
+			add_source('webp', 'image/webp', ImageVariant('WEBP', quality=100))
 		else:
-			name = image_info.out_name(image_info.base_ext)
-			mime = Image.MIME[image.format]
-			with g_target.checked_open(image_directory / name, 'wb') as f:
-				image.save(f)
-				picture.append(PicSrc(out_rel_url(name), mime))
+			add_source(image_info.base_ext, Image.MIME[image.format], ImageVariant(image.format))
 		
 		if image_info.type == 'banner':
 			banner_picture = picture
 		elif image_info.type == 'preview':
 			thumb_pictures = []
-			
-			thumb = image.copy()
 			thumb_size = (600, 200)
-			thumb.thumbnail(thumb_size, Image.ANTIALIAS)
-			
-			img = thumb.convert('RGB')
-			name = image_info.out_name('jpg', 'thumb')
-			with g_target.checked_open(image_directory / name, 'wb') as f:
-				img.save(f, 'JPEG')
-				thumb_pictures.append(PicSrc(out_rel_url(name), 'image/jpeg'))
+			thumb_width, thumb_height = fit_size(image.size, thumb_size)
 			
-			name = image_info.out_name('webp', 'thumb')
-			with g_target.checked_open(image_directory / name, 'wb') as f:
-				thumb.save(f, 'WebP')
-				thumb_pictures.append(PicSrc(out_rel_url(name), 'image/webp'))
+			for ext in thumb_profile.formats if thumb_profile else ['jpg', 'webp']:
+				name = image_info.out_name(ext, 'thumb')
+				if thumb_profile:
+					variant = profile_variant(thumb_profile, ext, thumb_size)
+				else:
+					variant = ImageVariant(OUTPUT_FORMATS[ext][0], thumb_size)
+				outputs.append(ImageOutput(image_directory / name, variant))
+				thumb_pictures.append(PicSrc(out_rel_url(name), OUTPUT_FORMATS[ext][1], thumb_width, thumb_height))
 
 			
 			foo.append(Foo(
 				image_info,
 				picture,
-				thumb_pictures
+				thumb_pictures,
+				placeholder(image_data)
 			))
 
-	mod.banner_picture = banner_picture
+		tasks.append(ImageTask(image_data, tuple(outputs)))
 
 	foo.sort(key=lambda x: x.image_info.get_id())
 	image_previews = []
 	for i, preview in enumerate(foo):
-		if i == 0:
-			prev_id = foo[-1].image_info.get_id()
-			next_id = foo[i + 1].image_info.get_id()
-		elif i == len(foo) - 1:
-			prev_id = foo[i - 1].image_info.get_id()
-			next_id = foo[0].image_info.get_id()
-		else:
-			prev_id = foo[i - 1].image_info.get_id()
-			next_id = foo[i + 1].image_info.get_id()
+		prev_id = foo[i - 1].image_info.get_id()
+		next_id = foo[(i + 1) % len(foo)].image_info.get_id()
 		
 		image_previews.append(PreviewEntry(
 			id=preview.image_info.get_id(),
@@ -180,22 +251,98 @@ def render_mod_page(config, app_args, all_mods: Tuple[Mod], all_grps, mod: Mod):
 			prev_id=prev_id,
 			next_id=next_id,
 			picture=preview.picture,
-			thumb_pictures=tuple(preview.thumb_pictures)
+			thumb_pictures=tuple(preview.thumb_pictures),
+			placeholder=preview.placeholder
 		))
-	
-	mod.image_previews = image_previews
-	
-	if mod.image_previews:
-		mod.picture_preview = mod.image_previews[0].thumb_pictures
-	
-	render_mod_page_main(config, all_mods, all_grps, mod)
 
+	return banner_picture, image_previews, tasks
+
+
+class ModPageJob(NamedTuple):
+	"""Everything render_mod_page needs, can be sent to another process"""
+	mod: Mod
+	manifest_key: str
+	input_fingerprint: str
+	info_data: bytes
+	page_files: Tuple[Tuple[str, bytes]]
+	image_paths: Tuple[PurePath]
+
+	def outputs(self):
+		mod_directory = PurePath(self.mod.repo.game_id, self.mod.repo.mod_id)
+		outputs = [mod_directory / 'index.html', mod_directory / 'mod-info.md']
+		outputs.extend(mod_directory / file_name for file_name, _ in self.page_files)
+		return outputs + list(self.image_paths)
+
+
+def prepare_mod_page(config, mod: Mod, image_processor: Optional[ImageProcessor]) -> Optional[ModPageJob]:
+	"""
+	Fetches the inputs of a mod page and hands its images to the image_processor.
+	Returns None if the page is up to date, the results of the last build are restored in that case.
+	"""
+	mod_directory = PurePath(mod.repo.game_id) / mod.repo.mod_id
+
+	# Skip everything, including image transcoding, when no input changed
+	manifest_key = f'mod:{mod_directory}'
+	input_fingerprint = mod_input_fingerprint(config, mod)
+	if g_manifest.is_fresh(manifest_key, input_fingerprint):
+		restore_mod_page_state(mod, g_manifest.get_state(manifest_key))
+		return None
+
+	# A failed fetch fails the page, recording it without the image would keep it fresh without the image
+	image_files = []
+	for file_name in mod.repo.list_dir(PurePath('image')):
+		image_files.append((file_name, mod.repo.get_file(PurePath('image', file_name))))
 
-def render_mod_page_main(config, all_mods, all_grps, mod: Mod):
+	page_files = []
+	for file_name in mod.repo.list_dir(PurePath('page')):
+		if file_name in ['index.html', 'image', 'mod-info.md']:
+			g_log.warn(f'Reserved filename {file_name} in page directory, skipped')
+			continue
+		page_files.append((file_name, mod.repo.get_file(PurePath('page', file_name))))
+
+	banner_picture, image_previews, image_tasks = plan_mod_images(
+		config,
+		mod_directory / 'image',
+		image_files,
+		image_processor.placeholder if image_processor else make_placeholder
+	)
+	image_paths = []
+	for task in image_tasks:
+		if image_processor:
+			image_processor.add_task(task.source, task.outputs)
+		image_paths.extend(output.path for output in task.outputs)
+
+	# Only the ids of the repository are needed, the repository itself can not leave this process
+	mod_ref = dataclasses.replace(
+		mod,
+		repo=RepositoryRef(mod.repo.game_id, mod.repo.mod_id),
+		banner_picture=banner_picture,
+		image_previews=image_previews
+	)
+	if image_previews:
+		mod_ref.picture_preview = image_previews[0].thumb_pictures
+
+	return ModPageJob(
+		mod=mod_ref,
+		manifest_key=manifest_key,
+		input_fingerprint=input_fingerprint,
+		info_data=mod.repo.get_file(PurePath('mod-info.md')),
+		page_files=tuple(page_files),
+		image_paths=tuple(image_paths)
+	)
+
+
+def render_mod_page(config, all_grps, job: ModPageJob) -> dict:
+	"""Renders the page, returns the mod_page_state() of the rendered mod"""
+	render_mod_page_main(config, all_grps, job.mod, job)
+	return mod_page_state(job.mod)
+
+
+def render_mod_page_main(config, all_grps, mod: Mod, job: ModPageJob):
 	
 	mod_directory = PurePath(mod.repo.game_id) / mod.repo.mod_id
 	
-	info_data = mod.repo.get_file(PurePath('mod-info.md'))
+	info_data = job.info_data
 	with g_target.checked_open(mod_directory / 'mod-info.md', 'wb') as f:
 		f.write(info_data)
 	
@@ -203,15 +350,9 @@ def render_mod_page_main(config, all_mods, all_grps, mod: Mod):
 	
 	mod_page_data = None
 	
-	page_files_gen = mod.repo.list_dir(PurePath('page'))
-	for file_name in page_files_gen:
-		if file_name in ['index.html', 'image', 'mod-info.md']:
-			g_log.warn(f'Reserved filename {file_name} in page directory, skipped')
-			continue
-
+	for file_name, file_data in job.page_files:
 		
 		# Just copy everything
-		file_data = mod.repo.get_file(file_path='page/' + file_name)
 		with g_target.checked_open(mod_directory / file_name, 'wb') as f:
 			f.write(file_data)
 		
@@ -227,7 +368,6 @@ def render_mod_page_main(config, all_mods, all_grps, mod: Mod):
 	
 	render_args = {
 		'config': config,
-		'mods': all_mods,
 		'groups': all_grps,
 		'mod': mod,
 		'info_html': info_html,
@@ -0,0 +1,160 @@
+# Copyright (c) 2020, Eli2
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import json
+import math
+import re
+import unicodedata
+from collections import Counter, defaultdict
+from pathlib import PurePath
+from typing import Dict, List, Tuple
+
+from .common import Mod
+from .target import g_target
+
+SEARCH_DIR = PurePath('search')
+
+# Terms are sharded by their first characters, search.js only fetches the shard of the typed prefix
+SHARD_PREFIX_LENGTH = 2
+
+# A term in the name counts as much as three in the description
+FIELD_WEIGHTS = {
+	'name': 3.0,
+	'creators': 2.0,
+	'description': 1.0,
+}
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Scores are stored as integers in hundredths
+SCORE_SCALE = 100
+
+_token_re = re.compile(r'[^\W_]+')
+
+
+def tokenize(text: str) -> List[str]:
+	"""Lower case words without accents, search.js normalizes queries the same way"""
+	text = unicodedata.normalize('NFKD', text or '')
+	text = ''.join(c for c in text if not unicodedata.combining(c))
+	return _token_re.findall(text.lower())
+
+
+def shard_key(term: str) -> str:
+	return term[:SHARD_PREFIX_LENGTH]
+
+
+def shard_file_name(key: str) -> str:
+	# Keeps file names ASCII, search.js looks them up in index.json
+	name = ''.join(c if c.isascii() and c.isalnum() else f'_{ord(c):x}_' for c in key)
+	return f'terms-{name}.bin'
+
+
+def write_varint(out: bytearray, value: int):
+	"""Unsigned LEB128"""
+	while value >= 0x80:
+		out.append((value & 0x7f) | 0x80)
+		value >>= 7
+	out.append(value)
+
+
+def mod_fields(mod: Mod) -> Dict[str, str]:
+	return {
+		'name': mod.info.name,
+		'creators': ' '.join(c.name for c in mod.info.creators),
+		'description': mod.info.description,
+	}
+
+
+def build_postings(all_mods: Tuple[Mod]) -> Dict[str, List[Tuple[int, int]]]:
+	"""term -> [(mod number, BM25 score)] sorted by mod number"""
+	term_frequencies = []
+	lengths = []
+	for mod in all_mods:
+		frequencies = Counter()
+		length = 0.0
+		for field, text in mod_fields(mod).items():
+			weight = FIELD_WEIGHTS[field]
+			for token in tokenize(text):
+				frequencies[token] += weight
+				length += weight
+		term_frequencies.append(frequencies)
+		lengths.append(length)
+
+	mod_count = len(all_mods)
+	average_length = sum(lengths) / mod_count if mod_count else 1.0
+
+	document_frequencies = Counter()
+	for frequencies in term_frequencies:
+		document_frequencies.update(frequencies.keys())
+
+	postings = defaultdict(list)
+	for mod_number, frequencies in enumerate(term_frequencies):
+		norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths[mod_number] / (average_length or 1.0))
+		for term, tf in frequencies.items():
+			df = document_frequencies[term]
+			idf = math.log(1 + (mod_count - df + 0.5) / (df + 0.5))
+			score = idf * tf * (BM25_K1 + 1) / (tf + norm)
+			postings[term].append((mod_number, max(1, round(score * SCORE_SCALE))))
+	return postings
+
+
+def encode_shard(entries: List[Tuple[str, List[Tuple[int, int]]]]) -> bytes:
+	"""
+	All numbers are varints:
+	term count, then per term: UTF-8 length, UTF-8 bytes, posting count, postings length in bytes, postings
+	A posting is the mod number as difference to the previous posting of the term, followed by the score.
+	"""
+	out = bytearray()
+	write_varint(out, len(entries))
+	for term, term_postings in entries:
+		encoded_term = term.encode('utf-8')
+		write_varint(out, len(encoded_term))
+		out += encoded_term
+
+		encoded_postings = bytearray()
+		previous = 0
+		for mod_number, score in term_postings:
+			write_varint(encoded_postings, mod_number - previous)
+			write_varint(encoded_postings, score)
+			previous = mod_number
+		write_varint(out, len(term_postings))
+		write_varint(out, len(encoded_postings))
+		out += encoded_postings
+	return bytes(out)
+
+
+def generate_search_data(all_mods: Tuple[Mod]):
+	"""
+	Writes the search index:
+	search/mods.json    compact table of the mods, the position is the mod number used by the postings
+	search/index.json   the shard of every prefix
+	search/terms-*.bin  sorted terms with their postings, see encode_shard()
+	"""
+	mods = []
+	for mod in all_mods:
+		mods.append([
+			f'{mod.repo.game_id}/{mod.repo.mod_id}/index.html',
+			mod.info.name,
+			', '.join(c.name for c in mod.info.creators),
+			mod.info.description
+		])
+
+	shards = defaultdict(list)
+	for term, term_postings in sorted(build_postings(all_mods).items()):
+		shards[shard_key(term)].append((term, term_postings))
+
+	for key, entries in shards.items():
+		with g_target.checked_open(SEARCH_DIR / shard_file_name(key), 'wb') as f:
+			f.write(encode_shard(entries))
+
+	with g_target.checked_open(SEARCH_DIR / 'mods.json', 'w') as f:
+		json.dump({'fields': ['path', 'name', 'creators', 'description'], 'mods': mods}, f,
+		          ensure_ascii=False, separators=(',', ':'))
+
+	with g_target.checked_open(SEARCH_DIR / 'index.json', 'w') as f:
+		json.dump({
+			'version': 2,
+			'prefixLength': SHARD_PREFIX_LENGTH,
+			'shards': {key: shard_file_name(key) for key in sorted(shards)}
+		}, f, ensure_ascii=False, separators=(',', ':'))
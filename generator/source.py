@@ -1,27 +1,126 @@
 # Copyright (c) 2020, Eli2
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+import hashlib
+import posixpath
+from collections import defaultdict
 from pathlib import PurePath
-from typing import NamedTuple, Tuple
+from typing import Iterable, List, NamedTuple, Optional, Tuple
 
 class ModDataFile(NamedTuple):
 	path: str
 	size: int
 
+
+class SnapshotEntry(NamedTuple):
+	path: str
+	type: str
+	size: Optional[int]
+	oid: Optional[str]
+
+
+def _snapshot_key(path) -> str:
+	key = str(PurePath(path)).strip('/')
+	if key == '.':
+		return ''
+	return key
+
+
+class RepositorySnapshot:
+	"""Complete file tree of a repository revision, answers listings without further requests"""
+
+	def __init__(self, entries: Iterable[SnapshotEntry]):
+		self._entries = {}
+		self._children = defaultdict(list)
+		for entry in entries:
+			self._entries[entry.path] = entry
+			self._children[posixpath.dirname(entry.path)].append(entry)
+
+	def __len__(self):
+		return len(self._entries)
+
+	def entries(self) -> Iterable[SnapshotEntry]:
+		return self._entries.values()
+
+	def get(self, path) -> Optional[SnapshotEntry]:
+		return self._entries.get(_snapshot_key(path))
+
+	def exists(self, path) -> bool:
+		return _snapshot_key(path) in self._entries
+
+	def list_dir(self, dir_path) -> List[str]:
+		return [e.path.rsplit('/', 1)[-1] for e in self._children.get(_snapshot_key(dir_path), [])]
+
+	def walk_blobs(self, dir_path) -> Iterable[SnapshotEntry]:
+		prefix = _snapshot_key(dir_path) + '/'
+		for entry in self._entries.values():
+			if entry.type == 'blob' and entry.path.startswith(prefix):
+				yield entry
+
+	def list_data_files(self) -> Tuple[ModDataFile]:
+		return tuple(ModDataFile(e.path, e.size) for e in self.walk_blobs('data'))
+
+
+class RepositoryRef(NamedTuple):
+	"""Identifies a repository without being able to access it"""
+	game_id: str
+	mod_id: str
+
+
+def git_blob_oid(data: bytes) -> str:
+	header = f'blob {len(data)}\0'.encode('ascii')
+	return hashlib.sha1(header + data).hexdigest()
+
+
 class RepositorySource:
 	def list_mods(self):
 		pass
 
+	def close(self):
+		pass
+
 
 class Repository:
-	def list_dir(self, dir_path: PurePath):
+	blob_cache = None
+	_snapshot: RepositorySnapshot = None
+
+	def get_snapshot(self) -> RepositorySnapshot:
+		if self._snapshot is None:
+			self._snapshot = self.fetch_snapshot()
+		return self._snapshot
+
+	def fetch_snapshot(self) -> RepositorySnapshot:
 		pass
-	
+
+	def list_dir(self, dir_path: PurePath):
+		return self.get_snapshot().list_dir(dir_path)
+
 	def list_data_files(self) -> Tuple[ModDataFile]:
-		pass
-	
+		return self.get_snapshot().list_data_files()
+
 	def get_file(self, file_path: PurePath):
+		oid = self.get_file_oid(file_path)
+		if not oid:
+			return None
+
+		if self.blob_cache:
+			data = self.blob_cache.get(oid)
+			if data is not None:
+				return data
+
+		data = self.fetch_blob(oid, file_path)
+		if data is not None and self.blob_cache:
+			self.blob_cache.put(oid, data)
+		return data
+
+	def get_file_oid(self, file_path: PurePath) -> Optional[str]:
+		entry = self.get_snapshot().get(file_path)
+		if not entry or entry.type != 'blob':
+			return None
+		return entry.oid
+
+	def fetch_blob(self, oid: str, file_path: PurePath) -> Optional[bytes]:
 		pass
-	
+
 	def get_star_count(self) -> int:
 		pass
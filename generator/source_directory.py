@@ -4,21 +4,21 @@
 
 import os
 from pathlib import Path
-from typing import Tuple
 
-from .source import ModDataFile, RepositorySource, Repository
+from .source import RepositorySnapshot, RepositorySource, Repository, SnapshotEntry, git_blob_oid
 
 
 class DirectorySource(RepositorySource):
 
-	def __init__(self, mod_base_path: str):
+	def __init__(self, mod_base_path: str, blob_cache=None):
 		self.path = Path(mod_base_path)
+		self.blob_cache = blob_cache
 	
 	def list_mods(self):
 		for game_id in os.listdir(self.path):
 			for mod_id in os.listdir(self.path / game_id):
 				path = self.path / game_id / mod_id
-				yield DirectoryProject(path, game_id, mod_id)
+				yield DirectoryProject(self, path, game_id, mod_id)
 
 
 class DirectoryProject(Repository):
@@ -26,36 +26,48 @@ class DirectoryProject(Repository):
 	game_id: str
 	mod_id: str
 	
-	def __init__(self, path, game_id, mod_id):
+	def __init__(self, src, path, game_id, mod_id):
 		self.p_path = path
 		self.game_id = game_id
 		self.mod_id = mod_id
+		self.blob_cache = src.blob_cache
+		self._oids = {}
 	
-	def list_dir(self, dir_path):
-		foo = self.p_path / dir_path
-		try:
-			for file_name in os.listdir(foo):
-				yield file_name
-		except FileNotFoundError:
-			yield from []
-	
-	def list_data_files(self) -> Tuple[ModDataFile]:
-		data_path = self.p_path / 'data'
-		result = []
-		for root, dirs, files in os.walk(data_path):
-			root_path = Path(root)
-			rel_dir = root_path.relative_to(data_path)
+	def fetch_snapshot(self):
+		entries = []
+		for root, dirs, files in os.walk(self.p_path):
+			if '.git' in dirs:
+				dirs.remove('.git')
+			rel_dir = Path(root).relative_to(self.p_path)
+			for name in dirs:
+				entries.append(SnapshotEntry((rel_dir / name).as_posix(), 'tree', None, None))
 			for name in files:
-				abs_path = root_path / name
 				rel_path = rel_dir / name
-				size = abs_path.stat().st_size
-				result.append(ModDataFile(str(rel_path), size))
-		return tuple(result)
+				size = (self.p_path / rel_path).stat().st_size
+				# Hashing every data file is expensive, see get_file_oid
+				entries.append(SnapshotEntry(rel_path.as_posix(), 'blob', size, None))
+		return RepositorySnapshot(entries)
 	
-	def get_file(self, file_path):
+	def get_file_oid(self, file_path):
 		foo = self.p_path / file_path
+		try:
+			stat = foo.stat()
+		except FileNotFoundError:
+			return None
 		if not foo.is_file():
 			return None
+
+		# Only rehash files that changed on disk
+		key = (str(file_path), stat.st_mtime_ns, stat.st_size)
+		oid = self._oids.get(key)
+		if not oid:
+			with open(foo, mode='rb') as file:
+				oid = git_blob_oid(file.read())
+			self._oids[key] = oid
+		return oid
+
+	def fetch_blob(self, oid, file_path):
+		foo = self.p_path / file_path
 		with open(foo, mode='rb') as file:
 			return file.read()
 	
@@ -0,0 +1,106 @@
+# Copyright (c) 2020, Eli2
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import os
+import threading
+from pathlib import Path, PurePath
+from typing import Dict, Iterable
+
+import git
+from git import GitCommandError
+
+from .common import g_log
+from .source import RepositorySnapshot, RepositorySource, Repository, SnapshotEntry
+
+# https://gitpython.readthedocs.io/en/stable/
+
+class GitMirrorSource(RepositorySource):
+	"""Keeps shallow bare clones of the mod repositories and reads everything from the local object database"""
+
+	remote_urls: Iterable[str]
+	mirror_path: Path
+	branch: str
+
+	def __init__(self, remote_urls: Iterable[str], mirror_dir, branch: str = 'master', star_counts: Dict[str, int] = None):
+		self.remote_urls = remote_urls
+		self.mirror_path = Path(mirror_dir)
+		self.branch = branch
+		# Clone URL -> star count, from the listing the URLs came from
+		self.star_counts = star_counts or {}
+		self.blob_cache = None
+
+		os.makedirs(self.mirror_path, exist_ok=True)
+
+	def list_mods(self):
+		for url in self.remote_urls:
+			repo_name = url.rstrip('/').rsplit('/', 1)[-1]
+			if repo_name.endswith('.git'):
+				repo_name = repo_name[:-4]
+
+			if not repo_name.startswith('mw_'):
+				g_log.info(f'Unexpected repo prefix {repo_name} skipping')
+				continue
+
+			game_id, mod_id = repo_name.split('_', 1)
+
+			yield GitMirrorRepository(self, url, self.mirror_path / (repo_name + '.git'), game_id, mod_id)
+
+
+class GitMirrorRepository(Repository):
+
+	game_id: str
+	mod_id: str
+
+	def __init__(self, src, url, path, game_id, mod_id):
+		self._src = src
+		self._url = url
+		self._path = path
+		self._repo = None
+		self._lock = threading.Lock()
+
+		self.game_id = game_id
+		self.mod_id = mod_id
+
+	def _update_mirror(self) -> git.Repo:
+		branch = self._src.branch
+		if not self._path.exists():
+			g_log.info(f'Cloning mirror of {self._url}')
+			return git.Repo.clone_from(self._url, self._path, bare=True, depth=1, branch=branch, single_branch=True)
+
+		# Only the objects of new commits are transferred
+		repo = git.Repo(self._path)
+		try:
+			repo.git.fetch(self._url, f'+refs/heads/{branch}:refs/heads/{branch}', depth=1)
+		except GitCommandError as ex:
+			# The last fetched state is still better than no mod at all
+			g_log.warning(f'Failed to update mirror of {self._url}, using the existing one: {ex}')
+		return repo
+
+	def _get_repo(self) -> git.Repo:
+		with self._lock:
+			if self._repo is None:
+				self._repo = self._update_mirror()
+			return self._repo
+
+	def fetch_snapshot(self):
+		try:
+			repo = self._get_repo()
+		except GitCommandError as ex:
+			g_log.error(f'Failed to clone mirror of {self._url}: {ex}')
+			raise
+
+		entries = []
+		tree = repo.commit(self._src.branch).tree
+		for item in tree.traverse():
+			if item.type == 'blob':
+				entries.append(SnapshotEntry(item.path, 'blob', item.size, item.hexsha))
+			elif item.type == 'tree':
+				entries.append(SnapshotEntry(item.path, 'tree', None, item.hexsha))
+		return RepositorySnapshot(entries)
+
+	def fetch_blob(self, oid, file_path: PurePath):
+		stream = self._get_repo().odb.stream(bytes.fromhex(oid))
+		return stream.read()
+
+	def get_star_count(self):
+		return self._src.star_counts.get(self._url, -1)
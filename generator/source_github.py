@@ -4,21 +4,27 @@
 import os
 import json
 import requests
-from sgqlc.endpoint.http import HTTPEndpoint
+from sgqlc.endpoint.requests import RequestsEndpoint
 
 import base64
+import queue
+import threading
 
-from pathlib import PurePath
+from typing import Dict
 
 from .common import g_log
-from .source import ModDataFile, RepositorySource, Repository
+from .http_session import SessionPool
+from .source import RepositorySnapshot, RepositorySource, Repository, SnapshotEntry, git_blob_oid
 
 
 # https://github.com/profusion/sgqlc
 
 class GitHubSource(RepositorySource):
 
-	def __init__(self):
+	# Largest page size the API accepts for connections
+	MAX_PAGE_SIZE = 100
+
+	def __init__(self, blob_cache=None, batch_size: int = 25, page_size: int = MAX_PAGE_SIZE, http_pool: SessionPool = None):
 
 		gh_token = os.environ.get('GH_TOKEN', None)
 		if gh_token:
@@ -27,32 +33,164 @@ class GitHubSource(RepositorySource):
 			headers = None
 			
 		self._headers = headers
+		self.blob_cache = blob_cache
+		self.batch_size = batch_size
+		self.page_size = max(1, min(page_size, self.MAX_PAGE_SIZE))
+
+		# GraphQL and REST requests share the connections to api.github.com
+		if not http_pool:
+			http_pool = SessionPool()
+		self.session = http_pool.get('https://api.github.com')
+		if headers:
+			self.session.headers.update(headers)
 		
-		self.endpoint = HTTPEndpoint('https://api.github.com/graphql', headers)
+		self.endpoint = RequestsEndpoint('https://api.github.com/graphql', session=self.session)
 
 	def list_mods(self):
+		# Pages are fetched in the background, callers can start on the first page right away
+		pages = queue.Queue(maxsize=2)
+
+		def produce():
+			try:
+				for page in self._list_repository_pages():
+					self.load_metadata(page)
+					pages.put(page)
+			except Exception as ex:
+				pages.put(ex)
+			pages.put(None)
+
+		threading.Thread(target=produce, name='github-list-mods', daemon=True).start()
+
+		while True:
+			page = pages.get()
+			if page is None:
+				break
+			if isinstance(page, Exception):
+				raise page
+			yield from page
+
+	def list_clone_urls(self) -> Dict[str, int]:
+		"""Clone URL -> star count of every repository"""
+		return {repo.clone_url(): repo.get_star_count() for page in self._list_repository_pages() for repo in page}
+
+	def _list_repository_pages(self):
 		query = '''
-		query {
+		query ($first: Int!, $cursor: String) {
 			organization(login:"nextmod") {
-				repositories(first: 10) {
+				repositories(first: $first, after: $cursor) {
+					pageInfo {
+						hasNextPage
+						endCursor
+					}
 					nodes{
 						name
+						stargazerCount
 					}
 				}
 			}
 		}'''
-		data = self.endpoint(query)
+		cursor = None
+		while True:
+			variables = {'first': self.page_size, 'cursor': cursor}
+			data = self.endpoint(query, variables)
+			repositories = data['data']['organization']['repositories']
 
-		for repo in data['data']['organization']['repositories']['nodes']:
-			repo_name = repo['name']
+			repos = []
+			for repo in repositories['nodes']:
+				repo_name = repo['name']
 
-			if not repo_name.startswith('mw_'):
-				g_log.info(f'Unexpected repo prefix {repo_name} skipping')
+				if not repo_name.startswith('mw_'):
+					g_log.info(f'Unexpected repo prefix {repo_name} skipping')
+					continue
+
+				game_id, mod_id = repo_name.split('_', 1)
+
+				gh_repo = GitHubRepository(self,  self.endpoint, 'nextmod', repo_name, game_id, mod_id)
+				gh_repo._star_count = repo['stargazerCount']
+				repos.append(gh_repo)
+			yield repos
+
+			page_info = repositories['pageInfo']
+			if not page_info['hasNextPage']:
+				break
+			cursor = page_info['endCursor']
+
+	def load_metadata(self, repos):
+		"""Fetch star count, mod-info.md and the top level tree of many repositories with aliased queries"""
+		pending = list(repos)
+		batch_size = self.batch_size
+		while pending:
+			batch = pending[:batch_size]
+			if not self._load_metadata_batch(batch) and batch_size > 1:
+				batch_size = max(1, len(batch) // 2)
+				g_log.warning(f'GraphQL query too expensive, retrying with batch size {batch_size}')
 				continue
+			pending = pending[len(batch):]
 
-			game_id, mod_id = repo_name.split('_', 1)
+	def _load_metadata_batch(self, batch) -> bool:
+		var_defs = []
+		fields = []
+		variables = {}
+		for i, repo in enumerate(batch):
+			var_defs.append(f'$owner{i}: String!, $name{i}: String!')
+			variables[f'owner{i}'] = repo._repo_owner
+			variables[f'name{i}'] = repo._repo_name
+			fields.append(f'''
+			r{i}: repository(owner: $owner{i}, name: $name{i}) {{
+				stargazers {{
+					totalCount
+				}}
+				info: object(expression: "master:mod-info.md") {{
+					... on Blob {{
+						oid
+						text
+						isBinary
+						isTruncated
+					}}
+				}}
+				root: object(expression: "master:") {{
+					... on Tree {{
+						oid
+						entries {{
+							name
+							type
+							oid
+						}}
+					}}
+				}}
+			}}''')
 
-			yield GitHubRepository(self,  self.endpoint, 'nextmod', repo_name, game_id, mod_id)
+		query = '''
+		query (''' + ', '.join(var_defs) + ''') {
+			rateLimit {
+				limit
+				cost
+				remaining
+				resetAt
+			}''' + ''.join(fields) + '''
+		}'''
+		scheduler = self.session.scheduler
+		for attempt in range(scheduler.max_retries + 1):
+			data = self.endpoint(query, variables)
+			errors = data.get('errors') or []
+			if not any(error.get('type') == 'RATE_LIMITED' for error in errors):
+				break
+			# The rate limit headers of the response already paused the scheduler
+			g_log.warning('GraphQL rate limited, retrying')
+
+		for error in errors:
+			if error.get('type') in ['MAX_NODE_LIMIT_EXCEEDED', 'RESOURCE_LIMITS_EXCEEDED']:
+				return False
+			g_log.error(f'GraphQL error: {error.get("message")}')
+
+		result = data.get('data') or {}
+		for i, repo in enumerate(batch):
+			repo_data = result.get(f'r{i}')
+			if repo_data:
+				repo.apply_metadata(repo_data)
+
+		scheduler.update_graphql(result.get('rateLimit'))
+		return True
 
 
 class GitHubRepository(Repository):
@@ -66,133 +204,111 @@ class GitHubRepository(Repository):
 	def __init__(self, src, endpoint, repo_owner, repo_name, game_id, mod_id):
 		self._src = src
 		self.endpoint = endpoint
+		self.blob_cache = src.blob_cache
 		self._repo_owner = repo_owner
 		self._repo_name = repo_name
 
 		self.game_id = game_id
 		self.mod_id = mod_id
 
-	def list_dir(self, dir_path):
-		dir_path = str(dir_path)
-		if not dir_path.endswith('/'):
-			dir_path += '/'
-		
-		query = '''
-		query ($repo_owner: String!, $repo_name: String!, $expression: String!) {
-		  repository(owner: $repo_owner, name: $repo_name) {    
-			object(expression: $expression) {
-			  ... on Tree {
-				entries {
-				  name
-				  type
-				}
-			  }
-			}
-		  }
-		}
-		'''
-		variables = {
-			'repo_owner': self._repo_owner,
-			'repo_name': self._repo_name,
-			'expression': 'master:' + dir_path
-		}
-		data = self.endpoint(query, variables)
+		self._star_count = None
+		self._root_tree = None
+		self._prefetched = {}
 
-		obj = data['data']['repository']['object']
-		if not obj:
-			return []
-		
-		entries = obj['entries']
-		names = [e['name'] for e in entries]
-		return names
+	def apply_metadata(self, repo_data):
+		self._star_count = repo_data['stargazers']['totalCount']
 
-	def list_data_files(self):
-		dir_path = 'data/'
-		
-		def gen_tree(depth: int):
-			if depth == 0:
-				return ''
-			return 'object {...on Blob{byteSize} ... on Tree {entries{name type ' + gen_tree(depth - 1) + '}}}'
+		info = repo_data['info']
+		if info and not info['isBinary'] and not info['isTruncated']:
+			# Blob.text is decoded, only keep it if it reproduces the original blob
+			info_data = info['text'].encode('utf-8')
+			if git_blob_oid(info_data) == info['oid']:
+				self._prefetched[info['oid']] = info_data
 
-		def gen_tree_frag():
-			return '... on Tree {entries{name type ' + gen_tree(8) + '}}'
+		self._root_tree = repo_data['root']
 
-		query = '''
-		query ($repo_owner: String!, $repo_name: String!, $expression: String!) {
-		  repository(owner: $repo_owner, name: $repo_name) {
-			object(expression: $expression) {
-			''' + gen_tree_frag() + '''
-			}
-		  }
-		}
-		'''
-		
-		variables = {
-			'repo_owner': self._repo_owner,
-			'repo_name': self._repo_name,
-			'expression': 'master:' + dir_path
-		}
-		data = self.endpoint(query, variables)
-		
-		root_obj = data['data']['repository']['object']
-		if root_obj:
-			flat = []
-			
-			def walk(obj, prefix):
-				for e in obj['entries']:
+	def clone_url(self):
+		return f'https://github.com/{self._repo_owner}/{self._repo_name}.git'
+
+	def _rest_url(self, *parts):
+		return '/'.join(["https://api.github.com", 'repos', self._repo_owner, self._repo_name] + list(parts))
+
+	def _fetch_tree(self, tree_ish, recursive):
+		params = {'recursive': '1'} if recursive else None
+		r = self._src.session.get(self._rest_url('git', 'trees', tree_ish), params=params)
+		r.raise_for_status()
+		return r.json()
+
+	def fetch_snapshot(self):
+		entries = []
+
+		def add_entries(tree, prefix):
+			for e in tree:
+				if e['type'] not in ['blob', 'tree']:
+					continue
+				entries.append(SnapshotEntry(prefix + e['path'], e['type'], e.get('size'), e['sha']))
+
+		tree_ish = 'master'
+		if self._root_tree:
+			tree_ish = self._root_tree['oid']
+			root_entries = self._root_tree['entries']
+			if all(e['type'] == 'blob' for e in root_entries):
+				# Nothing to recurse into, the batched metadata already has everything
+				return RepositorySnapshot(SnapshotEntry(e['name'], e['type'], None, e['oid']) for e in root_entries)
+
+			# Trees are content addressed as well, an unchanged root tree means an unchanged snapshot
+			if self.blob_cache:
+				cached = self.blob_cache.get(tree_ish)
+				if cached is not None:
+					return RepositorySnapshot(SnapshotEntry(*e) for e in json.loads(cached))
+
+		try:
+			data = self._fetch_tree(tree_ish, True)
+			if not data['truncated']:
+				add_entries(data['tree'], '')
+				snapshot = RepositorySnapshot(entries)
+				if self._root_tree and self.blob_cache:
+					self.blob_cache.put(tree_ish, json.dumps(entries).encode('utf-8'))
+				return snapshot
+
+			# Too large for a single response, walk it one tree at a time
+			g_log.warning(f'Tree listing of {self._repo_name} truncated, listing directories one by one')
+			pending = [(data['sha'], '')]
+			while pending:
+				sha, prefix = pending.pop()
+				tree = self._fetch_tree(sha, False)['tree']
+				add_entries(tree, prefix)
+				for e in tree:
 					if e['type'] == 'tree':
-						walk(e['object'], prefix + '/' + e['name'])
-					elif e['type'] == 'blob':
-						flat.append(('data' + prefix + '/' + e['name'], e['object']['byteSize']))
+						pending.append((e['sha'], prefix + e['path'] + '/'))
+		except requests.HTTPError as ex:
+			# A partial listing would silently drop files, fail the mod instead
+			g_log.error(f'Failed to list tree of {self._repo_name}: {ex}')
+			raise
 
-			
-			walk(root_obj, '')
-			return flat
-		else:
-			return []
+		return RepositorySnapshot(entries)
 
-	def get_file(self, file_path: PurePath):
-		
-		query = '''
-		query($owner:String!, $name:String!, $exp:String!) {
-			repository(owner: $owner, name: $name) {
-				object(expression: $exp) {
-					... on Blob {
-						oid
-					}
-				}	
-			}
-		}'''
-		variables = {
-			'owner': self._repo_owner,
-			'name': self._repo_name,
-			'exp': 'master:' + str(file_path)
-		}
-		data = self.endpoint(query, variables)
-		
-		oid = data['data']['repository']['object']['oid']
+	def fetch_blob(self, oid, file_path):
+		prefetched = self._prefetched.pop(oid, None)
+		if prefetched is not None:
+			return prefetched
 		
 		# No clue how to do this with API v4, use v3 (2020.05)
 
-		foo = ["https://api.github.com", 'repos', self._repo_owner, self._repo_name, 'git', 'blobs', oid]
-		bar = '/'.join(foo)
-		
-		try:
-			r = requests.get(bar, headers=self._src._headers)
-			r.raise_for_status()
-			j = r.json()
-			if j['encoding'] == 'base64':
-				data = base64.b64decode(j['content'])
-			else:
-				g_log.error("Unexpected encoding")
-			return data
-		except Exception as ex:
-			g_log.exception(ex)
+		# Transient errors are retried by the session, anything left is a real failure
+		r = self._src.session.get(self._rest_url('git', 'blobs', oid))
+		r.raise_for_status()
+		j = r.json()
+		if j['encoding'] == 'base64':
+			return base64.b64decode(j['content'])
+		else:
+			g_log.error("Unexpected encoding")
 			return None
-	
-
 
 	def get_star_count(self):
+		if self._star_count is not None:
+			return self._star_count
+
 		query = '''
 		query($repo_owner:String!, $repo_name:String!) {
 			repository(owner: $repo_owner, name: $repo_name) {
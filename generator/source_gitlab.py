@@ -1,33 +1,100 @@
 # Copyright (c) 2020, Eli2
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
-from pathlib import PurePath
+import json
+import os
+import threading
+from pathlib import Path
 
 import gitlab
-from gitlab import Gitlab, GitlabGetError
+from gitlab import Gitlab, GitlabError, GitlabGetError
 
 from .common import g_log
-from .source import ModDataFile, RepositorySource, Repository
+from .http_session import SessionPool
+from .source import ModDataFile, RepositorySnapshot, RepositorySource, Repository, SnapshotEntry
 
 # https://python-gitlab.readthedocs.io/en/stable/
 
 class GitlabSource(RepositorySource):
 	gl: Gitlab
 	root_group_path: str
+
+	# Number of paths per GraphQL blobs query
+	SIZE_BATCH = 100
 	
-	def __init__(self):
+	def __init__(self, blob_cache=None, http_pool: SessionPool = None, size_index_path=None):
 		self.root_group_path = 'nextmod/mod'
-		self.gl = Gitlab('https://gitlab.com')
+
+		if not http_pool:
+			http_pool = SessionPool()
+		self.session = http_pool.get('https://gitlab.com')
+		self.gl = Gitlab('https://gitlab.com', session=self.session)
+		self.blob_cache = blob_cache
+	
+		# Blob sizes never change, remember them across builds
+		self._size_index_path = Path(size_index_path) if size_index_path else None
+		self._sizes = {}
+		self._sizes_lock = threading.Lock()
+		if self._size_index_path and self._size_index_path.exists():
+			with open(self._size_index_path, encoding='utf-8') as file:
+				self._sizes = json.load(file)
 	
 	def list_mods(self):
-		root_group = self.gl.groups.get(self.root_group_path)
-		for game_subgroup in root_group.subgroups.list():
-			game_id = game_subgroup.name
-			game_group = self.gl.groups.get(game_subgroup.id)
-			for mod_groupproject in game_group.projects.list():
-				mod_id = mod_groupproject.name
-				project = self.gl.projects.get(mod_groupproject.id, lazy=False)
-				yield GitlabProject(self, project, game_id, mod_id)
+		# One paginated listing of every project below the root group
+		root_group = self.gl.groups.get(self.root_group_path, lazy=True)
+		projects = root_group.projects.list(include_subgroups=True, iterator=True, per_page=100)
+		for mod_groupproject in projects:
+			namespace = mod_groupproject.namespace
+			if namespace['full_path'] == self.root_group_path:
+				g_log.info(f'Project {mod_groupproject.name} is not in a game group, skipping')
+				continue
+			game_id = namespace['name']
+			mod_id = mod_groupproject.name
+			project = self.gl.projects.get(mod_groupproject.id, lazy=True)
+			yield GitlabProject(self, project, mod_groupproject.path_with_namespace, game_id, mod_id,
+			                    mod_groupproject.star_count)
+
+	def close(self):
+		if not self._size_index_path:
+			return
+		with self._sizes_lock:
+			os.makedirs(self._size_index_path.parent, exist_ok=True)
+			with open(self._size_index_path, 'w', encoding='utf-8') as file:
+				json.dump(self._sizes, file)
+
+	def get_blob_sizes(self, full_path: str, blobs):
+		with self._sizes_lock:
+			missing = [b for b in blobs if b.oid not in self._sizes]
+
+		query = '''
+		query($fullPath: ID!, $paths: [String!]!, $first: Int!) {
+			project(fullPath: $fullPath) {
+				repository {
+					blobs(ref: "master", paths: $paths, first: $first) {
+						nodes {
+							path
+							size
+						}
+					}
+				}
+			}
+		}'''
+		for i in range(0, len(missing), self.SIZE_BATCH):
+			chunk = missing[i:i + self.SIZE_BATCH]
+			variables = {'fullPath': full_path, 'paths': [b.path for b in chunk], 'first': len(chunk)}
+			r = self.session.post('https://gitlab.com/api/graphql', json={'query': query, 'variables': variables})
+			r.raise_for_status()
+			data = r.json()
+			if data.get('errors'):
+				raise GitlabGetError(data['errors'][0].get('message'))
+
+			oids = {b.path: b.oid for b in chunk}
+			with self._sizes_lock:
+				for node in data['data']['project']['repository']['blobs']['nodes']:
+					self._sizes[oids[node['path']]] = int(node['size'])
+
+		with self._sizes_lock:
+			return {b.oid: self._sizes.get(b.oid) for b in blobs}
 
 
 class GitlabProject(Repository):
@@ -37,45 +104,37 @@ class GitlabProject(Repository):
 	
 	p_project = None
 	
-	def __init__(self, src, proj, game_id, mod_id):
+	def __init__(self, src, proj, full_path, game_id, mod_id, star_count):
 		self.src = src
 		self.p_project = proj
+		self.p_full_path = full_path
+		self.blob_cache = src.blob_cache
 		self.game_id = game_id
 		self.mod_id = mod_id
+		self.star_count = star_count
 		
 	
-	def list_dir(self, dir_path):
-		path_str = str(dir_path)
-		files = self.p_project.repository_tree(path=path_str, ref='master', recursive=False, as_list=False)
-		for f in files:
-			yield f['name']
-	
-	def list_data_files(self):
-		data_path = "data/"
+	def fetch_snapshot(self):
 		try:
-			result = []
-			files = self.p_project.repository_tree(path=data_path, ref='master', recursive=True, as_list=False)
+			entries = []
+			files = self.p_project.repository_tree(ref='master', recursive=True, iterator=True, per_page=100)
 			for f in files:
-				if f['type'] == 'tree':
-					continue
-				blob_id = f['id']
-				path = f['path']
-				file_info = self.p_project.repository_blob(blob_id)
-				size = file_info['size']
-				result.append(ModDataFile(path, size))
-			return tuple(result)
-		except GitlabGetError as ex:
+				entries.append(SnapshotEntry(f['path'], f['type'], None, f['id']))
+			return RepositorySnapshot(entries)
+		except GitlabError as ex:
+			# A partial listing would silently drop files, fail the mod instead
 			g_log.error("gitlab failed to list files: %s", ex)
-			return []
+			raise
 	
-	def get_file(self, file_path: PurePath):
-		path_str = str(file_path)
-		try:
-			file_data = self.p_project.files.get(file_path=path_str, ref='master').decode()
-			return file_data
-		except GitlabGetError as ex:
-			g_log.error("gitlab failed to get file %s: %s", file_path, ex)
-			return None
+	def list_data_files(self):
+		# The tree listing does not contain sizes, ask for them in bulk
+		blobs = list(self.get_snapshot().walk_blobs('data'))
+		sizes = self.src.get_blob_sizes(self.p_full_path, blobs)
+		return tuple(ModDataFile(f.path, sizes[f.oid] or 0) for f in blobs)
+	
+	def fetch_blob(self, oid, file_path):
+		# Transient errors are retried by the session, anything left is a real failure
+		return self.p_project.repository_raw_blob(oid)
 	
 	def get_star_count(self):
-		return self.p_project.attributes['star_count']
+		return self.star_count
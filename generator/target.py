@@ -1,41 +1,178 @@
 # Copyright (c) 2020, Eli2
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+import io
 import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path, PurePath
+from typing import Dict
 
 from .common import g_log
 
+
+class _OutputBuffer(io.BytesIO):
+	"""Collects the content of an output file, hands it to the target when closed"""
+
+	def __init__(self, target, path: PurePath):
+		super().__init__()
+		self._target = target
+		self._path = path
+
+	def close(self):
+		if not self.closed:
+			self._target.write_file(self._path, self.getvalue())
+		super().close()
+
+
 class DirectoryTarget():
+	"""
+	Writes the output files below ./public.
+	Files are only replaced when their content changed, so unchanged outputs keep their mtime and
+	deploys only upload the differences. Writes are atomic and can be done by a background thread pool.
+	"""
+
 	g_public_dir: Path
-	
+	written_count: int
+	unchanged_count: int
+
 	def __init__(self):
 		self.g_public_dir = Path('./public').resolve(strict=True)
 		if not self.g_public_dir.exists():
 			raise Exception('Target directory does not exist')
-	
+
 		g_log.info(f'Writing to directory: {self.g_public_dir}')
-		
+
+		self.written_count = 0
+		self.unchanged_count = 0
+		self._lock = threading.Lock()
+		# Output directory -> resolved directory, validated and created once
+		self._directories: Dict[PurePath, Path] = {}
+		# Content of writes still queued on the pool
+		self._pending: Dict[PurePath, bytes] = {}
+		self._futures = []
+		self._pool = None
+		if hasattr(os, 'register_at_fork'):
+			os.register_at_fork(after_in_child=self._after_fork)
+
+	def _after_fork(self):
+		# Render processes inherit neither the pool threads nor a lock they might hold, they write directly
+		self._lock = threading.Lock()
+		self._futures = []
+		self._pool = None
+
+	def start(self, worker_count: int):
+		"""Writes in the background from now on, until finish()"""
+		if worker_count > 0:
+			self._pool = ThreadPoolExecutor(max_workers=worker_count, thread_name_prefix='write')
+
+	def finish(self):
+		"""Waits for the queued writes, raises the first error of them"""
+		with self._lock:
+			futures = self._futures
+			self._futures = []
+		for future in futures:
+			future.result()
+		if self._pool:
+			self._pool.shutdown()
+			self._pool = None
+
+		g_log.info(f'Output: {self.written_count} files written, {self.unchanged_count} unchanged')
+
+	def exists(self, path: PurePath) -> bool:
+		with self._lock:
+			if path in self._pending:
+				return True
+		return (self.g_public_dir / path).is_file()
+
+	def _resolve(self, path: PurePath) -> Path:
+		directory = path.parent
+		resolved_dir = self._directories.get(directory)
+		if resolved_dir is None:
+			resolved_dir = (self.g_public_dir / directory).resolve()
+			if os.path.commonpath([self.g_public_dir, resolved_dir]) != str(self.g_public_dir):
+				raise Exception(f'Weird file loacation: {resolved_dir}')
+			os.makedirs(resolved_dir, exist_ok=True)
+			self._directories[directory] = resolved_dir
+		file_path = (resolved_dir / path.name).resolve()
+		if file_path.parent != resolved_dir:
+			raise Exception(f'Weird file loacation: {file_path}')
+		return file_path
+
 	def checked_open(self, path: PurePath, mode='r'):
 		if not isinstance(path,  PurePath):
 			raise Exception('Wrong parameter type"')
-		
-		abs_path = self.g_public_dir / path
-		resolved_path = abs_path.resolve()
-		
-		common_prefix = os.path.commonprefix([self.g_public_dir, resolved_path])
-		if not os.path.samefile(self.g_public_dir, common_prefix):
-			raise Exception(f'Weird file loacation: {resolved_path}')
-		
-		os.makedirs(resolved_path.parent, exist_ok=True)
-		
+
+		if mode in ['w', 'wb']:
+			buffer = _OutputBuffer(self, path)
+			if mode == 'w':
+				return io.TextIOWrapper(buffer, encoding='utf-8', newline='')
+			return buffer
+
+		with self._lock:
+			data = self._pending.get(path)
+		if data is not None:
+			# Not written yet, read what will be written
+			buffer = io.BytesIO(data)
+			return io.TextIOWrapper(buffer, encoding='utf-8', newline='') if mode == 'r' else buffer
+
 		buffer_size = 1024 * 8
 		if mode == 'r' or mode == 'w':
 			encoding = 'utf-8'
 		else:
 			encoding = None
-		
-		return open(resolved_path, mode, buffer_size, encoding)
+
+		return open(self._resolve(path), mode, buffer_size, encoding)
+
+	def write_file(self, path: PurePath, data: bytes):
+		if not self._pool:
+			self._write_file(path, data)
+			return
+
+		with self._lock:
+			self._pending[path] = data
+			self._futures.append(self._pool.submit(self._write_pending, path, data))
+
+	def _write_pending(self, path: PurePath, data: bytes):
+		try:
+			self._write_file(path, data)
+		finally:
+			with self._lock:
+				# A newer write of the same path may have been queued meanwhile
+				if self._pending.get(path) is data:
+					del self._pending[path]
+
+	def _write_file(self, path: PurePath, data: bytes):
+		file_path = self._resolve(path)
+		try:
+			if file_path.stat().st_size == len(data):
+				with open(file_path, 'rb') as file:
+					unchanged = file.read() == data
+			else:
+				unchanged = False
+		except FileNotFoundError:
+			unchanged = False
+
+		if unchanged:
+			g_log.debug(f'Unchanged: {path}')
+			with self._lock:
+				self.unchanged_count += 1
+			return
+
+		fd, tmp_path = tempfile.mkstemp(prefix='.' + file_path.name, suffix='.tmp', dir=file_path.parent)
+		try:
+			with os.fdopen(fd, 'wb') as file:
+				file.write(data)
+			os.chmod(tmp_path, 0o644)
+			os.replace(tmp_path, file_path)
+		except BaseException:
+			os.remove(tmp_path)
+			raise
+
+		g_log.debug(f'Written: {path}')
+		with self._lock:
+			self.written_count += 1
 
 
 g_target = DirectoryTarget()
@@ -6,16 +6,22 @@
 
 import argparse
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
 from generator.common import *
+from generator.blob_cache import BlobCache
+from generator.http_session import HttpSettings, SessionPool
 from generator.file_parsers import ConfigFile, InfoFileParser
 from generator.image_processor import ImageProcessor
+from generator.manifest import g_manifest
 
 from generator.render_about import render_about_page
-from generator.render_mod import render_mod_page
+from generator.render_mod import prepare_mod_page, render_mod_page, restore_mod_page_state
 from generator.render_index import render_index_pages
+from generator.search_index import generate_search_data
 
 from generator.source_directory import DirectorySource
+from generator.source_git_mirror import GitMirrorSource
 from generator.source_github import GitHubSource
 from generator.source_gitlab import GitlabSource
 
@@ -24,27 +30,33 @@ from generator.target import g_target
 
 image_processor = ImageProcessor()
 
-def load_mod_repositories(repositories) -> Tuple[Mod]:
-	g_log.info('Loading mod data ...')
-
-	foo = list(repositories)
-
-	mods = []
-	for repo in foo:
-		g_log.info(f'Loading: {repo.game_id}~{repo.mod_id}')
-		
+def load_mod(repo) -> Optional[Mod]:
+	g_log.info(f'Loading: {repo.game_id}~{repo.mod_id}')
+	try:
 		mod = Mod(repo=repo)
-				
+
 		mod.star_count = repo.get_star_count()
 		mod.data_files = repo.list_data_files()
 		mod.data_files_size = sum(size for name, size in mod.data_files)
-		
+
 		info_parser = InfoFileParser()
 		info_parser.parse(repo.get_file('mod-info.md'))
 		mod.info = info_parser.get_result()
 
-		mods.append(mod)
-	return tuple(mods)
+		return mod
+	except Exception as ex:
+		g_log.error(f'Failed to load: {repo.game_id}~{repo.mod_id}')
+		g_log.exception(ex)
+		return None
+
+
+def load_mod_repositories(repositories, worker_count: int) -> Tuple[Mod]:
+	g_log.info('Loading mod data ...')
+
+	# map() keeps the order of the repositories, no matter which one finishes first
+	with ThreadPoolExecutor(max_workers=worker_count, thread_name_prefix='load') as executor:
+		mods = executor.map(load_mod, repositories)
+		return tuple(mod for mod in mods if mod)
 
 
 def build_groups(all_mods: Tuple[Mod]) -> Tuple[Group]:
@@ -80,33 +92,42 @@ def build_groups(all_mods: Tuple[Mod]) -> Tuple[Group]:
 	return tuple(groups)
 
 
-def generate_search_data(all_mods: Tuple[Mod]):
-
-	mods = {}
-	all_words = []
+def render_mod_pages(config, app_args, all_mods: Tuple[Mod], all_grps: Tuple[Group]):
 
-	def preprocess_words(mod_id: str, string: str, prio: int):
-		words = string.lower().split(' ')
-		for word in words:
-			all_words.append([word, prio, mod_id])
+	# Pages only show the group names, GroupSpec.key_getter can not be pickled anyway
+	header_grps = tuple(Group(spec=g.spec._replace(key_getter=None), entries=()) for g in all_grps)
 
-	for mod in all_mods:
-		mods[mod.repo.mod_id] = {
-			'name': mod.info.name,
-			'creators': mod.info.creators,
-			'description': mod.info.description,
-			'thumbnail': mod.image_preview
-		}
-		preprocess_words(mod.repo.mod_id, mod.info.name, 10)
-		for creator in mod.info.creators:
-			preprocess_words(mod.repo.mod_id, creator.name, 8)
-		preprocess_words(mod.repo.mod_id, mod.info.description, 3)
-
-	data = {'mods': mods, 'words': all_words}
+	def prepare(mod):
+		try:
+			return prepare_mod_page(config, mod, None if app_args.dev_skip_image_transcode else image_processor)
+		except Exception as ex:
+			g_log.error(f'Failed to prepare mod page for: {mod.repo.mod_id}')
+			g_log.exception(ex)
+			return None
 
-	import json
-	with g_target.checked_open(PurePath('search-data.json'), 'w') as f:
-		json.dump(data, f, ensure_ascii=False, indent=1)
+	if app_args.jobs > 1:
+		render_pool = ProcessPoolExecutor(max_workers=app_args.jobs, mp_context=process_context())
+	else:
+		render_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='render')
+
+	# Inputs are fetched on threads, rendering happens as soon as the inputs of a mod arrived
+	with ThreadPoolExecutor(max_workers=app_args.load_workers, thread_name_prefix='fetch') as fetch_pool, render_pool:
+		futures = {}
+		for mod, job in zip(all_mods, fetch_pool.map(prepare, all_mods)):
+			if job:
+				g_log.info('Generating mod page for: {}'.format(mod.repo.mod_id))
+				futures[render_pool.submit(render_mod_page, config, header_grps, job)] = (mod, job)
+
+		for future in as_completed(futures):
+			mod, job = futures[future]
+			try:
+				state = future.result()
+			except Exception as ex:
+				g_log.error(f'Failed to generate mod page for: {mod.repo.mod_id}')
+				g_log.exception(ex)
+				continue
+			restore_mod_page_state(mod, state)
+			g_manifest.record(job.manifest_key, job.input_fingerprint, job.outputs(), state)
 
 
 def generate_index_json(all_mods: Tuple[Mod]):
@@ -127,6 +148,22 @@ def main():
 	parser = argparse.ArgumentParser(description='Static site generator for browsing mod repositories')
 	parser.add_argument('-s', '--source', choices=['local', 'gitlab', 'github', 'remotes'])
 	parser.add_argument('--dev-skip-image-transcode', action='store_true')
+	parser.add_argument('--full-rebuild', action='store_true', help='Ignore the build manifest and render every page')
+	parser.add_argument('--cache-dir', default='./.cache', help='Directory for persistent build caches')
+	parser.add_argument('--blob-cache-size', type=int, default=2048, help='Size cap of the blob cache in MiB')
+	parser.add_argument('--image-cache-size', type=int, default=1024, help='Size cap of the encoded image cache in MiB')
+	parser.add_argument('--github-batch-size', type=int, default=25, help='Repositories per batched GraphQL query')
+	parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of processes rendering mod pages')
+	parser.add_argument('--image-jobs', type=int, default=None, help='Number of processes transcoding images, defaults to the CPU count')
+	parser.add_argument('--write-jobs', type=int, default=4, help='Number of threads writing output files, 0 writes synchronously')
+	parser.add_argument('--load-workers', type=int, default=8, help='Number of mods loaded concurrently')
+	parser.add_argument('--github-page-size', type=int, default=GitHubSource.MAX_PAGE_SIZE, help='Repositories per discovery page')
+	parser.add_argument('--http-pool-size', type=int, default=None, help='Connections kept per host, defaults to --load-workers')
+	parser.add_argument('--http-connect-timeout', type=float, default=10.0, help='Seconds')
+	parser.add_argument('--http-read-timeout', type=float, default=60.0, help='Seconds')
+	parser.add_argument('--http-no-keep-alive', action='store_true', help='Close connections after every request')
+	parser.add_argument('--http-rate', type=float, default=10.0, help='Maximum requests per second and host')
+	parser.add_argument('--http-max-retries', type=int, default=5, help='Retries of rate limited and failed requests')
 
 	app_args = parser.parse_args()
 	
@@ -135,28 +172,46 @@ def main():
 		cfg_file.parse(file.read())
 	
 	config = cfg_file.get_result()
+
+	g_manifest.load(g_target.g_public_dir.parent / '.nextmod-manifest.json', not app_args.full_rebuild)
 	
 
+	blob_cache = BlobCache(Path(app_args.cache_dir) / 'blob', app_args.blob_cache_size * 1024 * 1024)
+
+	http_pool = SessionPool(HttpSettings(
+		pool_size=app_args.http_pool_size or app_args.load_workers,
+		connect_timeout=app_args.http_connect_timeout,
+		read_timeout=app_args.http_read_timeout,
+		keep_alive=not app_args.http_no_keep_alive,
+		rate=app_args.http_rate,
+		burst=app_args.http_rate,
+		max_retries=app_args.http_max_retries
+	))
+
 	if app_args.source == 'local':
-		source = DirectorySource('../mod')
+		source = DirectorySource('../mod', blob_cache)
 	elif app_args.source == 'gitlab':
-		source = GitlabSource()
+		source = GitlabSource(blob_cache, http_pool, Path(app_args.cache_dir) / 'gitlab-blob-sizes.json')
 	elif app_args.source == 'github':
-		source = GitHubSource()
+		source = GitHubSource(blob_cache, app_args.github_batch_size, app_args.github_page_size, http_pool)
 	elif app_args.source == 'remotes':
-		source = GitHubSource()
+		remotes = config.remotes
+		star_counts = None
+		if not remotes:
+			github = GitHubSource(None, app_args.github_batch_size, app_args.github_page_size, http_pool)
+			star_counts = github.list_clone_urls()
+			remotes = tuple(star_counts)
+		source = GitMirrorSource(remotes, Path(app_args.cache_dir) / 'mirror', star_counts=star_counts)
 	else:
 		raise Exception('Unexpected source argument')
 
-	all_mods = load_mod_repositories(source.list_mods())
+	all_mods = load_mod_repositories(source.list_mods(), app_args.load_workers)
 	all_grps = build_groups(all_mods)
 
-	for mod in all_mods:
-		g_log.info('Generating mod page for: {}'.format(mod.repo.mod_id))
-		try:
-			render_mod_page(config, app_args, all_mods, all_grps, mod)
-		except Exception as ex:
-			g_log.exception(ex)
+	g_target.start(app_args.write_jobs)
+	image_cache = BlobCache(Path(app_args.cache_dir) / 'image', app_args.image_cache_size * 1024 * 1024)
+	image_processor.start(app_args.image_jobs, image_cache)
+	render_mod_pages(config, app_args, all_mods, all_grps)
 
 	g_log.info('Generating search data')
 	generate_search_data(all_mods)
@@ -169,6 +224,17 @@ def main():
 
 	generate_index_json(all_mods)
 
+	image_processor.finish()
+	g_target.finish()
+
+	source.close()
+	http_pool.close()
+
+	g_manifest.save()
+	g_log.info(f'Pages: {g_manifest.built_count} rendered, {g_manifest.fresh_count} unchanged')
+
+	g_log.info(f'Blob cache: {blob_cache.hits} hits, {blob_cache.misses} misses, {blob_cache.size} bytes')
+	g_log.info(f'Image cache: {image_cache.hits} hits, {image_cache.misses} misses, {image_cache.size} bytes')
 	g_log.info('DONE')
 
 
@@ -0,0 +1,251 @@
+// Copyright (c) 2020, Eli2
+// SPDX-License-Identifier: AGPL-3.0-or-later
+
+// Loads the search index and answers queries off the main thread, started by search.js.
+// Messages in:  {type: 'search', id, query}, ids increase with every keystroke
+// Messages out: {type: 'results', id, results, first, done}, the results of a query arrive in chunks
+//               {type: 'error', id, message}
+
+// The index lives in the search directory next to _static, wherever the site is deployed
+const g_search = shardedSearchEngine(new URL('../search/', self.location.href).href);
+
+// Results sent per message, the best ones show up before the rest are transferred
+const RESULT_CHUNK_SIZE = 10;
+
+let g_latestId = 0;
+
+class Cancelled extends Error {}
+
+self.onmessage = async (event)=>{
+	const message = event.data;
+	if(message.type !== 'search') {
+		return;
+	}
+
+	const id = message.id;
+	g_latestId = Math.max(g_latestId, id);
+	const isStale = ()=> id !== g_latestId;
+
+	try {
+		g_search.load();
+		const results = await g_search.search(message.query, isStale);
+
+		let first = true;
+		for(let start = 0; first || start < results.length; start += RESULT_CHUNK_SIZE) {
+			if(isStale()) {
+				return;
+			}
+			const chunk = results.slice(start, start + RESULT_CHUNK_SIZE);
+			const done = start + RESULT_CHUNK_SIZE >= results.length;
+			self.postMessage({type: 'results', id, results: chunk, first, done});
+			first = false;
+			if(!done) {
+				// Lets a newer query arrive before the next chunk
+				await new Promise(resolve => setTimeout(resolve, 0));
+			}
+		}
+	} catch(error) {
+		if(!(error instanceof Cancelled)) {
+			self.postMessage({type: 'error', id, message: String(error)});
+		}
+	}
+};
+
+
+// The generator writes a sorted term dictionary split into shards by prefix, see generator/search_index.py.
+// Only the shards of the query terms are fetched, their terms are binary searched and the
+// varint encoded posting lists of the matches intersected. Scores are precomputed BM25 values.
+function shardedSearchEngine(baseUrl) {
+	const MAX_RESULTS = 50;
+
+	let index;
+	let mods;
+	const shards = new Map();
+	const textDecoder = new TextDecoder();
+
+	const fetchResponse = (name)=>{
+		return fetch(baseUrl + name).then(response => {
+			if(!response.ok) {
+				throw new Error(`${response.status} ${response.url}`);
+			}
+			return response;
+		});
+	};
+
+	// Same normalization as tokenize() of the generator
+	const tokenize = (text)=>{
+		const normalized = text.normalize('NFKD').replace(/\p{M}/gu, '').toLowerCase();
+		return normalized.match(/[\p{L}\p{N}]+/gu) || [];
+	};
+
+	const parseShard = (buffer)=>{
+		const bytes = new Uint8Array(buffer);
+		let pos = 0;
+		const readVarint = ()=>{
+			let value = 0;
+			let shift = 0;
+			let byte;
+			do {
+				byte = bytes[pos++];
+				value += (byte & 0x7f) * 2 ** shift;
+				shift += 7;
+			} while(byte & 0x80);
+			return value;
+		};
+
+		const count = readVarint();
+		const terms = new Array(count);
+		const postingCounts = new Uint32Array(count);
+		const postingOffsets = new Uint32Array(count);
+		for(let i = 0; i < count; i++) {
+			const length = readVarint();
+			terms[i] = textDecoder.decode(bytes.subarray(pos, pos + length));
+			pos += length;
+			postingCounts[i] = readVarint();
+			const byteLength = readVarint();
+			postingOffsets[i] = pos;
+			pos += byteLength;
+		}
+		return {bytes, terms, postingCounts, postingOffsets};
+	};
+
+	// Adds the postings of term i to scores, keeping the best score of every mod
+	const readPostings = (shard, i, scores)=>{
+		const bytes = shard.bytes;
+		let pos = shard.postingOffsets[i];
+		let mod = 0;
+		for(let n = 0; n < shard.postingCounts[i]; n++) {
+			const values = [0, 0];
+			for(let v = 0; v < 2; v++) {
+				let shift = 0;
+				let byte;
+				do {
+					byte = bytes[pos++];
+					values[v] += (byte & 0x7f) * 2 ** shift;
+					shift += 7;
+				} while(byte & 0x80);
+			}
+			mod += values[0];
+			if(!(scores.get(mod) >= values[1])) {
+				scores.set(mod, values[1]);
+			}
+		}
+	};
+
+	// First term that is not less than the query
+	const lowerBound = (terms, query)=>{
+		let low = 0;
+		let high = terms.length;
+		while(low < high) {
+			const mid = (low + high) >>> 1;
+			if(terms[mid] < query) {
+				low = mid + 1;
+			} else {
+				high = mid;
+			}
+		}
+		return low;
+	};
+
+	const loadShard = (key, fileName)=>{
+		if(!shards.has(key)) {
+			shards.set(key, fetchResponse(fileName)
+				.then(response => response.arrayBuffer())
+				.then(parseShard));
+		}
+		return shards.get(key);
+	};
+
+	const loadMods = ()=>{
+		if(!mods) {
+			mods = fetchResponse('mods.json')
+				.then(response => response.json())
+				.then(data => data.mods.map(row => {
+					const mod = {};
+					data.fields.forEach((field, i) => mod[field] = row[i]);
+					return mod;
+				}));
+		}
+		return mods;
+	};
+
+	// mod -> score of every mod containing the term, or a term starting with it when prefix is set
+	const lookup = async (searchIndex, term, prefix)=>{
+		let keys;
+		if(Array.from(term).length >= searchIndex.prefixLength) {
+			keys = [Array.from(term).slice(0, searchIndex.prefixLength).join('')];
+		} else if(prefix) {
+			// Shorter than a shard prefix, every shard starting with the term can match
+			keys = Object.keys(searchIndex.shards).filter(key => key.startsWith(term));
+		} else {
+			keys = [term];
+		}
+		keys = keys.filter(key => key in searchIndex.shards);
+		const loaded = await Promise.all(keys.map(key => loadShard(key, searchIndex.shards[key])));
+
+		const scores = new Map();
+		for(const shard of loaded) {
+			for(let i = lowerBound(shard.terms, term); i < shard.terms.length; i++) {
+				const matches = prefix ? shard.terms[i].startsWith(term) : shard.terms[i] === term;
+				if(!matches) {
+					break;
+				}
+				readPostings(shard, i, scores);
+			}
+		}
+		return scores;
+	};
+
+	return {
+		'load': ()=>{
+			if(!index) {
+				index = fetchResponse('index.json').then(response => response.json());
+			}
+		},
+		// Throws Cancelled as soon as isStale() reports a newer query
+		'search': async (query, isStale)=>{
+			const checkStale = ()=>{
+				if(isStale()) {
+					throw new Cancelled();
+				}
+			};
+
+			const terms = Array.from(new Set(tokenize(query)));
+			if(terms.length === 0) {
+				return [];
+			}
+
+			const searchIndex = await index;
+			checkStale();
+			// The last word may still be typed, it matches as a prefix
+			const lastWordComplete = /[^\p{L}\p{N}]$/u.test(query);
+			const postingLists = await Promise.all(terms.map((term, i) =>
+				lookup(searchIndex, term, i === terms.length - 1 && !lastWordComplete)));
+			checkStale();
+
+			// Intersect, starting with the shortest list
+			postingLists.sort((a, b) => a.size - b.size);
+			let results = postingLists[0];
+			for(const list of postingLists.slice(1)) {
+				const next = new Map();
+				for(const [mod, score] of results) {
+					const other = list.get(mod);
+					if(other !== undefined) {
+						next.set(mod, score + other);
+					}
+				}
+				results = next;
+			}
+			if(results.size === 0) {
+				return [];
+			}
+
+			const modTable = await loadMods();
+			checkStale();
+			return Array.from(results)
+				.sort((a, b) => b[1] - a[1] || a[0] - b[0])
+				.slice(0, MAX_RESULTS)
+				.map(([mod, score]) => modTable[mod]);
+		}
+	}   
+}
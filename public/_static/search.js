@@ -24,9 +24,49 @@ searchBoxWrap.appendChild(searchBox);
 
 
 let g_searchResultEl;
+let g_searchResultList;
+let g_searchWorker;
+let g_searchGeneration = 0;
 
 
-const g_seaarch = trivialSearchEngine()
+const createEl = (parent, tag)=>{
+	const el = document.createElement(tag)
+	parent.appendChild(el);
+	return el;
+}
+
+// Loading and querying the index happens in the worker, next to this script
+const startSearchWorker = ()=>{
+	const worker = new Worker(new URL('search-worker.js', searchScript.src));
+	worker.onmessage = (ev)=>{
+		const message = ev.data;
+		// Results of an older query must not replace newer ones
+		if(message.id !== g_searchGeneration) {
+			return;
+		}
+		if(message.type === 'error') {
+			console.error(message.message);
+			return;
+		}
+
+		if(message.first) {
+			g_searchResultEl.innerText = '';
+			g_searchResultList = createEl(g_searchResultEl, 'ul');
+		}
+		const frag = new DocumentFragment();
+		for(const mod of message.results) {
+			const li = createEl(frag, 'li');
+			createEl(li, 'p').innerText = mod.name;
+			createEl(li, 'p').innerText = mod.creators;
+			createEl(li, 'p').innerText = mod.description;
+		}
+		g_searchResultList.appendChild(frag);
+	};
+	worker.onerror = (ev)=>{
+		console.error(ev.message);
+	};
+	return worker;
+};
 
 
 searchBox.onfocus = (ev)=>{
@@ -35,7 +75,9 @@ searchBox.onfocus = (ev)=>{
 		g_searchResultEl.classList.add('search-results');
 		searchBox.insertAdjacentElement('afterend', g_searchResultEl);
 
-		g_seaarch.load();
+		g_searchWorker = startSearchWorker();
+		// An empty query already loads the index
+		g_searchWorker.postMessage({type: 'search', id: ++g_searchGeneration, query: ''});
 	}
 	g_searchResultEl.classList.remove('hidden');	
 };
@@ -45,76 +87,5 @@ searchBox.onblur = (ev)=>{
 }
 
 searchBox.oninput = (ev)=>{
-
-	const createEl = (parent, tag)=>{
-		const el = document.createElement(tag)
-		parent.appendChild(el);
-		return el;
-	}
-	
-	const results = g_seaarch.search(searchBox.value);
-
-	const frag = new DocumentFragment();
-	const ul = createEl(frag, 'ul');
-	for(const result of results) {
-		const mod = result[0];
-		const word = result[1][0];
-		
-		const li = createEl(ul, 'li');
-		createEl(li, 'p').innerText = mod.name;
-		createEl(li, 'p').innerText = mod.creator;
-		createEl(li, 'p').innerText = mod.description;
-	}
-	g_searchResultEl.innerText = '';
-	g_searchResultEl.appendChild(frag);
-}
-
-
-function trivialSearchEngine() {
-	let mods;
-	let words;
-
-	return {
-		'load': ()=>{
-			// TODO proper relative URL
-			fetch('/search-data.json')
-			.then(response => response.json())
-			.then(data => {
-				mods = data.mods;
-				words = data.words;
-			})
-			.catch(error => console.error(error))
-		},
-		'search': (query)=>{
-			if(!query) {
-				return [];
-			}
-
-			query = query.toLowerCase();
-
-			result = []
-			for(word of words) {
-				if(word[0].startsWith(query)) {
-					result.push(word);
-				}
-			}
-			result.sort((a, b) => {
-				return a[1] - b[1];
-				//return a.last_nom.localeCompare(b.last_nom)
-			});
-
-			const map = new Map();
-			for(r of result) {
-				map.set(r[2], r);
-			}
-			
-			const argh = []
-			map.forEach((value, key, map)=>{
-				argh.push([mods[key], value]);
-			});
-
-			return argh;
-		}
-	}   
+	g_searchWorker.postMessage({type: 'search', id: ++g_searchGeneration, query: searchBox.value});
 }
-
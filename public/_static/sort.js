@@ -0,0 +1,48 @@
+// Copyright (c) 2020, Eli2
+// SPDX-License-Identifier: AGPL-3.0-or-later
+
+// Sorts the tiles of a listing in the browser, the tiles carry their rank for every sort key
+// as data-sort<sort id> attributes. Without JS the page shows the default order.
+
+(() => {
+	const modList = document.querySelector('.mod-list');
+	const sortLinks = Array.from(document.querySelectorAll('.sort-by a[data-sort-id]'));
+	if (!modList || sortLinks.length === 0) {
+		return;
+	}
+
+	const tiles = Array.from(modList.children);
+
+	const sortTiles = (link) => {
+		const attribute = 'data-sort' + link.dataset.sortId;
+		const descending = link.dataset.descending === 'true';
+		const ranks = new Map(tiles.map(tile => [tile, Number(tile.getAttribute(attribute))]));
+
+		const sorted = tiles.slice().sort((a, b) => ranks.get(a) - ranks.get(b));
+		if (descending) {
+			sorted.reverse();
+		}
+		modList.append(...sorted);
+
+		for (const other of sortLinks) {
+			other.classList.toggle('active', other === link);
+		}
+	};
+
+	const linkForHash = (hash) => {
+		return sortLinks.find(link => hash === '#sort' + link.dataset.sortId + link.dataset.order);
+	};
+
+	for (const link of sortLinks) {
+		link.addEventListener('click', event => {
+			event.preventDefault();
+			sortTiles(link);
+			history.replaceState(null, '', '#sort' + link.dataset.sortId + link.dataset.order);
+		});
+	}
+
+	const initial = linkForHash(location.hash);
+	if (initial) {
+		sortTiles(initial);
+	}
+})();